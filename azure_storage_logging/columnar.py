@@ -0,0 +1,301 @@
+# Copyright 2013-2015 Michiya Takahashi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Writer of log records in Parquet format, which uses pyarrow if it's
+installed, or falls back to a pure Python implementation otherwise.
+"""
+import struct
+import zlib
+
+# types of the columns
+TIMESTAMP = 'timestamp'
+INT32 = 'int32'
+STRING = 'string'
+
+MAGIC = b'PAR1'
+
+# enums in parquet.thrift
+_TYPE_INT32 = 1
+_TYPE_INT64 = 2
+_TYPE_BYTE_ARRAY = 6
+_REPETITION_OPTIONAL = 1
+_CONVERTED_UTF8 = 0
+_CONVERTED_TIMESTAMP_MILLIS = 9
+_ENCODING_PLAIN = 0
+_ENCODING_RLE = 3
+_CODEC_GZIP = 2
+_PAGE_DATA = 0
+
+_PHYSICAL_TYPES = {
+    TIMESTAMP: _TYPE_INT64,
+    INT32: _TYPE_INT32,
+    STRING: _TYPE_BYTE_ARRAY,
+}
+
+# types in the thrift compact protocol
+_CT_TRUE = 1
+_CT_FALSE = 2
+_CT_I32 = 5
+_CT_I64 = 6
+_CT_BINARY = 8
+_CT_LIST = 9
+_CT_STRUCT = 12
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        if n < 0x80:
+            out.append(n)
+            return bytes(out)
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+
+def _zigzag(n):
+    return _varint((n << 1) ^ (n >> 63))
+
+
+class _Struct(object):
+    """
+    Thrift struct serialized with the compact protocol, whose fields
+    are given in ascending order of their ids.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.last = 0
+
+    def _header(self, fid, ctype):
+        delta = fid - self.last
+        if 0 < delta <= 15:
+            self.buf += struct.pack('B', (delta << 4) | ctype)
+        else:
+            self.buf += struct.pack('B', ctype) + _zigzag(fid)
+        self.last = fid
+
+    def i32(self, fid, value):
+        self._header(fid, _CT_I32)
+        self.buf += _zigzag(value)
+        return self
+
+    def i64(self, fid, value):
+        self._header(fid, _CT_I64)
+        self.buf += _zigzag(value)
+        return self
+
+    def bool(self, fid, value):
+        self._header(fid, _CT_TRUE if value else _CT_FALSE)
+        return self
+
+    def binary(self, fid, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        self._header(fid, _CT_BINARY)
+        self.buf += _varint(len(value)) + value
+        return self
+
+    def struct(self, fid, value):
+        self._header(fid, _CT_STRUCT)
+        self.buf += value.dump()
+        return self
+
+    def list(self, fid, ctype, values):
+        self._header(fid, _CT_LIST)
+        if len(values) < 15:
+            self.buf += struct.pack('B', (len(values) << 4) | ctype)
+        else:
+            self.buf += struct.pack('B', 0xf0 | ctype) + _varint(len(values))
+        for value in values:
+            if ctype == _CT_STRUCT:
+                self.buf += value.dump()
+            elif ctype == _CT_BINARY:
+                if not isinstance(value, bytes):
+                    value = value.encode('utf-8')
+                self.buf += _varint(len(value)) + value
+            else:
+                self.buf += _zigzag(value)
+        return self
+
+    def dump(self):
+        return bytes(self.buf) + b'\x00'
+
+
+def _schemaElement(name, ctype):
+    element = _Struct()
+    element.i32(1, _PHYSICAL_TYPES[ctype])
+    element.i32(3, _REPETITION_OPTIONAL)
+    element.binary(4, name)
+    if ctype == TIMESTAMP:
+        element.i32(6, _CONVERTED_TIMESTAMP_MILLIS)
+        unit = _Struct().struct(1, _Struct())
+        timestamp = _Struct().bool(1, True).struct(2, unit)
+        element.struct(10, _Struct().struct(8, timestamp))
+    elif ctype == STRING:
+        element.i32(6, _CONVERTED_UTF8)
+        element.struct(10, _Struct().struct(1, _Struct()))
+    return element
+
+
+def _definitionLevels(values):
+    """
+    Return the definition levels of the optional column in
+    the RLE encoding with the bit width of 1.
+    """
+    out = bytearray()
+    i = 0
+    while i < len(values):
+        level = values[i] is not None
+        j = i + 1
+        while j < len(values) and (values[j] is not None) == level:
+            j += 1
+        out += _varint((j - i) << 1) + struct.pack('B', level)
+        i = j
+    return struct.pack('<i', len(out)) + bytes(out)
+
+
+def _plainValues(ctype, values):
+    out = bytearray()
+    for value in values:
+        if value is None:
+            continue
+        if ctype == TIMESTAMP:
+            out += struct.pack('<q', value)
+        elif ctype == INT32:
+            out += struct.pack('<i', value)
+        else:
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            out += struct.pack('<i', len(value)) + value
+    return bytes(out)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _PurePythonWriter(object):
+
+    def __init__(self, f, schema):
+        self.f = f
+        self.schema = schema
+        self.offset = 0
+        self.row_groups = []
+        self.num_rows = 0
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def write_row_group(self, rows):
+        chunks = []
+        total_size = 0
+        for i, (name, ctype) in enumerate(self.schema):
+            values = [row[i] for row in rows]
+            page = _definitionLevels(values) + _plainValues(ctype, values)
+            compressed = _gzip(page)
+            header = _Struct()
+            header.i32(1, _PAGE_DATA)
+            header.i32(2, len(page))
+            header.i32(3, len(compressed))
+            header.struct(5, _Struct().i32(1, len(values))
+                                      .i32(2, _ENCODING_PLAIN)
+                                      .i32(3, _ENCODING_RLE)
+                                      .i32(4, _ENCODING_RLE))
+            header = header.dump()
+            offset = self.offset
+            self._write(header)
+            self._write(compressed)
+            meta = _Struct()
+            meta.i32(1, _PHYSICAL_TYPES[ctype])
+            meta.list(2, _CT_I32, [_ENCODING_PLAIN, _ENCODING_RLE])
+            meta.list(3, _CT_BINARY, [name])
+            meta.i32(4, _CODEC_GZIP)
+            meta.i64(5, len(values))
+            meta.i64(6, len(header) + len(page))
+            meta.i64(7, len(header) + len(compressed))
+            meta.i64(9, offset)
+            chunks.append(_Struct().i64(2, offset).struct(3, meta))
+            total_size += len(header) + len(page)
+        self.row_groups.append(_Struct().list(1, _CT_STRUCT, chunks)
+                                        .i64(2, total_size)
+                                        .i64(3, len(rows)))
+        self.num_rows += len(rows)
+
+    def close(self):
+        root = _Struct().binary(4, 'schema').i32(5, len(self.schema))
+        elements = [root] + [_schemaElement(name, ctype)
+                             for name, ctype in self.schema]
+        meta = _Struct()
+        meta.i32(1, 1)
+        meta.list(2, _CT_STRUCT, elements)
+        meta.i64(3, self.num_rows)
+        meta.list(4, _CT_STRUCT, self.row_groups)
+        meta.binary(6, 'azure-storage-logging')
+        footer = meta.dump()
+        self._write(footer)
+        self._write(struct.pack('<i', len(footer)))
+        self._write(MAGIC)
+
+
+class _ArrowWriter(object):
+
+    def __init__(self, f, schema):
+        import pyarrow
+        import pyarrow.parquet
+        types = {TIMESTAMP: pyarrow.timestamp('ms', tz='UTC'),
+                 INT32: pyarrow.int32(),
+                 STRING: pyarrow.string()}
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, types[ctype])
+                                      for name, ctype in schema])
+        self.writer = pyarrow.parquet.ParquetWriter(f, self.schema,
+                                                    compression='gzip')
+
+    def write_row_group(self, rows):
+        arrays = [self.pyarrow.array([row[i] for row in rows], type=field.type)
+                  for i, field in enumerate(self.schema)]
+        table = self.pyarrow.Table.from_arrays(arrays, schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(rows))
+
+    def close(self):
+        self.writer.close()
+
+
+def _writer(f, schema):
+    try:
+        return _ArrowWriter(f, schema)
+    except ImportError:
+        return _PurePythonWriter(f, schema)
+
+
+def write_parquet(f, schema, rows, row_group_size=10000):
+    """
+    Write the rows into the file object f in Parquet format, in the row
+    groups of row_group_size rows. The schema is a sequence of the name
+    and the type of every column, and every row is a sequence of the
+    values of the columns, None for a null.
+    """
+    writer = _writer(f, schema)
+    group = []
+    for row in rows:
+        group.append(row)
+        if len(group) >= row_group_size:
+            writer.write_row_group(group)
+            group = []
+    if group:
+        writer.write_row_group(group)
+    writer.close()
@@ -11,34 +11,970 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
+import itertools
+import json
 import logging
 import os
+import re
 import string
 import sys
+import threading
+import time
+import weakref
 from base64 import b64encode
+from collections import OrderedDict, deque
 from datetime import datetime
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from logging.handlers import (MemoryHandler, RotatingFileHandler, SocketHandler,
+                              TimedRotatingFileHandler)
 from socket import gethostname
-from tempfile import mkstemp
-from zipfile import ZIP_DEFLATED, ZipFile
 
-from azure.storage.blob import BlockBlobService
-from azure.storage.blob.models import ContentSettings
-from azure.storage.queue import QueueService
-from azure.storage.table import TableBatch, TableService
+# the service classes of azure-storage and the modules only required for
+# uploading log files are imported when they are used for the first time,
+# so that importing this module stays cheap
 
 _PY3 = sys.version_info[0] == 3
 
+# name of the Unix domain socket on which the shipper process receives
+# log records, in the runtime directory of the user by default
+SHIPPER_SOCKET_NAME = 'azure-storage-logging.sock'
+
+
+class _Meta(dict):
+    """
+    Values for the handler-specific formats, which looks up the hostname
+    only when it is required.
+    """
+    def __missing__(self, key):
+        if key != 'hostname':
+            raise KeyError(key)
+        value = self['hostname'] = self._gethostname()
+        return value
+
+    def _gethostname(self):
+        return gethostname()
+
+
+class _ContainerMeta(_Meta):
+
+    def _gethostname(self):
+        # underscores are not allowed in container names
+        return gethostname().replace('_', '-')
+
+
+# length of the idempotency keys, which are hexadecimal SHA-1 hashes
+IDEMPOTENCY_KEY_LENGTH = 40
+
+
+class _IdempotencyKeys(object):
+    """
+    Deterministic keys of the records emitted by a handler, which are
+    the hashes of the hostname, the process, the time when the handler
+    was created and the sequence number of the record.
+    """
+    def __init__(self, meta):
+        from hashlib import sha1
+        self.sha1 = sha1
+        self.meta = meta
+        self.epoch = int(time.time() * 1000)
+        # next() of itertools.count is atomic, no lock is required
+        self.seq = itertools.count()
+
+    def next(self):
+        # the process is looked up every time for the forked processes
+        source = '%s|%d|%d|%d' % (self.meta['hostname'], os.getpid(),
+                                  self.epoch, next(self.seq))
+        return self.sha1(source.encode('utf-8')).hexdigest()
+
+
+# fields of the name templates, and the escaped characters
+_NAME_FIELD = re.compile(r'\$\{(\w+)\}|\$(\w+)|\{(\w+)(?::([^{}]*))?\}|'
+                         r'%\((\w+)\)([#0 +-]*\d*(?:\.\d+)?[diouxXeEfFgGcrs])|'
+                         r'(\$\$|\{\{|\}\}|%%)')
+
+
+class _NameTemplate(object):
+    """
+    Name of containers, queues, tables, blobs or files compiled from
+    a template, in which the fields are given as ``$name``, ``${name}``,
+    ``{name}``, ``{name:spec}`` or ``%(name)s``.
+
+    The names of the templates that have other fields than the hostname
+    and the process are resolved for every log record from its attributes,
+    and made valid by sanitize if it's given.
+    """
+    STATIC_FIELDS = frozenset(['hostname', 'process'])
+    # maximum number of the resolved names to cache
+    CACHE_SIZE = 1024
+
+    def __init__(self, template, sanitize=None):
+        self.template = template
+        self.sanitize = sanitize
+        # literal text, or tuples of the name, the spec and the style of fields
+        self.parts = []
+        fields = []
+        pos = 0
+        for m in _NAME_FIELD.finditer(template):
+            if m.start() > pos:
+                self.parts.append(template[pos:m.start()])
+            pos = m.end()
+            if m.group(7):
+                self.parts.append(m.group(7)[0])
+                continue
+            if m.group(5):
+                field = (m.group(5), '%' + m.group(6), '%')
+            elif m.group(3):
+                field = (m.group(3), m.group(4) or '', '{')
+            else:
+                field = (m.group(1) or m.group(2), '', '$')
+            self.parts.append(field)
+            if field[0] not in fields:
+                fields.append(field[0])
+        if pos < len(template):
+            self.parts.append(template[pos:])
+        self.fields = tuple(fields)
+        self.dynamic = not self.STATIC_FIELDS.issuperset(fields)
+        self.cache = {}
+
+    def render(self, params):
+        """
+        Return the name with the fields filled in from the mapping params.
+        """
+        out = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                name, spec, style = part
+                value = params[name]
+                if style == '%':
+                    part = spec % (value,)
+                elif spec:
+                    part = format(value, spec)
+                else:
+                    part = '%s' % (value,)
+            out.append(part)
+        return ''.join(out)
+
+    def resolve(self, record):
+        """
+        Return the name for the log record, which is cached by the values
+        of the fields so that it's usually found by a dict lookup.
+        """
+        values = tuple(getattr(record, field) for field in self.fields)
+        try:
+            return self.cache[values]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable values are never cached
+            return self._sanitized(dict(zip(self.fields, values)))
+        if len(self.cache) >= self.CACHE_SIZE:
+            self.cache.clear()
+        name = self.cache[values] = self._sanitized(dict(zip(self.fields, values)))
+        return name
+
+    def _sanitized(self, params):
+        name = self.render(params)
+        if self.sanitize:
+            name = self.sanitize(name)
+        return name
+
 
 def _formatName(name, params):
-    if _PY3:
-        # try all possible formattings
-        name = string.Template(name).substitute(**params)
-        name = name.format(**params)
-    return name % params
+    return _NameTemplate(name).render(params)
+
+
+def _queueName(name):
+    """
+    Return the valid queue name for the resolved name, which consists of
+    lower-case letters, digits and single hyphens between them.
+    """
+    name = re.sub(r'-{2,}', '-', re.sub(r'[^a-z0-9-]', '-', name.lower()))
+    return name.strip('-')[:63].rstrip('-')
+
+
+def _tableName(name):
+    """
+    Return the valid table name for the resolved name, which consists of
+    lower-case letters and digits, and starts with a letter.
+    """
+    name = re.sub(r'[^a-z0-9]', '', name.lower())
+    if name[:1].isdigit():
+        name = 't' + name
+    return name[:63]
+
+
+# sanitizers of the dynamic names by the kind of the resources
+_NAME_SANITIZERS = {
+    'queue': _queueName,
+    'table': _tableName,
+}
+
+
+def _isMissingResource(error):
+    return getattr(error, 'status_code', None) == 404
+
+
+# index of the failed operation at the head of the error message of
+# a batch transaction, such as "1:One of the request inputs is not valid."
+_FAILED_OPERATION_INDEX = re.compile(r'(?:^|[>"\s])(\d+):\D')
+
+
+def _failedOperationIndex(error):
+    """
+    Return the index of the operation that made the batch transaction
+    fail, or None if the error isn't caused by one of the operations.
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None or not 400 <= status_code < 500:
+        return None
+    match = _FAILED_OPERATION_INDEX.search('%s' % (error,))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class _ResourceCache(object):
+    """
+    Containers, queues and tables known to exist, shared by all handlers
+    in the process and optionally by other processes through marker files.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.known = set()
+
+    def _marker(self, key, directory):
+        return os.path.join(directory, '.'.join(str(k) for k in key))
+
+    def _hasMarker(self, key, directory, ttl):
+        try:
+            mtime = os.path.getmtime(self._marker(key, directory))
+        except OSError:
+            return False
+        return ttl is None or time.time() - mtime < ttl
+
+    def _putMarker(self, key, directory):
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = self._marker(key, directory)
+            open(path, 'a').close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # the markers are only hints for other processes
+            pass
+
+    def ensure(self, key, create, directory=None, ttl=None):
+        """
+        Create the resource unless it is already known to exist.
+        """
+        if key in self.known:
+            return
+        if directory and self._hasMarker(key, directory, ttl):
+            with self.lock:
+                self.known.add(key)
+            return
+        create()
+        with self.lock:
+            self.known.add(key)
+        if directory:
+            self._putMarker(key, directory)
+
+    def discard(self, key, directory=None):
+        """
+        Forget the resource, which turned out not to exist.
+        """
+        with self.lock:
+            self.known.discard(key)
+        if directory:
+            try:
+                os.remove(self._marker(key, directory))
+            except OSError:
+                pass
+
+    def call(self, key, create, func, directory=None, ttl=None):
+        """
+        Call func after ensuring the resource exists, and call it again
+        after creating the resource if the resource has been deleted.
+        """
+        self.ensure(key, create, directory, ttl)
+        try:
+            return func()
+        except Exception as e:
+            if not _isMissingResource(e):
+                raise
+        self.discard(key, directory)
+        self.ensure(key, create, directory, ttl)
+        return func()
+
+
+_resources = _ResourceCache()
+
+# prefix of queue messages whose log text is compressed
+COMPRESSED_MESSAGE_PREFIX = 'zlib:'
+
+# value of the message_encoding property of table entities whose
+# message property is compressed
+COMPRESSED_MESSAGE_ENCODING = 'zlib'
+
+
+def _loadCompressionDict(compression_dict):
+    """
+    Return the preset dictionary for compression given as bytes
+    or a path to the file that contains it.
+    """
+    if compression_dict is None:
+        return None
+    if not _PY3:
+        raise ValueError('compression_dict requires Python 3')
+    if not isinstance(compression_dict, bytes):
+        with open(compression_dict, 'rb') as f:
+            compression_dict = f.read()
+    return compression_dict
+
+
+class _Compressor(object):
+    """
+    Compresses log text in zlib format if it is large enough to benefit.
+    """
+    def __init__(self, threshold, compression_dict=None):
+        import zlib
+        self.threshold = threshold
+        zdict = _loadCompressionDict(compression_dict)
+        if zdict:
+            self.compressobj = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                zlib.DEFLATED,
+                                                zlib.MAX_WBITS,
+                                                zlib.DEF_MEM_LEVEL,
+                                                zlib.Z_DEFAULT_STRATEGY,
+                                                zdict)
+        else:
+            self.compressobj = zlib.compressobj()
+
+    def compress(self, text):
+        """
+        Return the compressed text, or None if it's not worth compressing.
+        """
+        data = text.encode('utf-8')
+        if len(data) < self.threshold:
+            return None
+        # copying the compressor saves priming it with the dictionary
+        c = self.compressobj.copy()
+        compressed = c.compress(data) + c.flush()
+        if len(compressed) >= len(data):
+            return None
+        return compressed
+
+
+# prefix of queue messages that have the template ID and the arguments
+# of the log message instead of the log text
+TEMPLATE_MESSAGE_PREFIX = 'template:'
+
+# partition key of the entities of the templates in the template table
+TEMPLATE_PARTITION_KEY = 'template'
+
+# placeholder of the message to find the log text around it
+_MESSAGE_MARKER = '\x00message\x00'
+
+if _PY3:
+    _TEMPLATE_ARG_TYPES = (str, int, float, type(None))
+else:
+    _TEMPLATE_ARG_TYPES = (basestring, int, long, float, type(None))
+
+
+# prefix of queue messages that refer to the traceback in the traceback
+# table, followed by the ID of the traceback and the length of the log
+# text before the traceback
+TRACEBACK_REFERENCE_PREFIX = 'traceback:'
+
+# prefix of queue messages whose log text would otherwise start with
+# one of the prefixes above, so that the log text is read as it is
+PLAIN_MESSAGE_PREFIX = 'text:'
+
+_RESERVED_PREFIXES = (COMPRESSED_MESSAGE_PREFIX,
+                      TEMPLATE_MESSAGE_PREFIX,
+                      TRACEBACK_REFERENCE_PREFIX,
+                      PLAIN_MESSAGE_PREFIX)
+
+# partition key of the entities of the tracebacks in the traceback table
+TRACEBACK_PARTITION_KEY = 'traceback'
+
+# the messages between the chained exceptions in tracebacks
+_CAUSE_MESSAGE = ('\nThe above exception was the direct cause '
+                  'of the following exception:\n\n')
+_CONTEXT_MESSAGE = ('\nDuring handling of the above exception, '
+                    'another exception occurred:\n\n')
+
+
+class _TracebackCache(object):
+    """
+    Formatted tracebacks of exceptions shared by all handlers in the
+    process, which are keyed by their fingerprints, the types of the
+    exceptions and the code locations of the frames, so that the same
+    traceback repeated by many log records is formatted only once.
+    """
+    def __init__(self, size=1024):
+        from hashlib import sha1
+        self.sha1 = sha1
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _chain(self, value, tb):
+        # the chained exceptions from the first one, with the messages
+        # that follow them
+        chain = []
+        seen = set()
+        message = ''
+        while value is not None and id(value) not in seen:
+            seen.add(id(value))
+            chain.append((value, tb, message))
+            cause = getattr(value, '__cause__', None)
+            context = getattr(value, '__context__', None)
+            if cause is not None:
+                value, message = cause, _CAUSE_MESSAGE
+            elif context is not None and not getattr(value, '__suppress_context__', False):
+                value, message = context, _CONTEXT_MESSAGE
+            else:
+                value = None
+            tb = getattr(value, '__traceback__', None)
+        chain.reverse()
+        return chain
+
+    def _frames(self, tb):
+        frames = []
+        while tb is not None:
+            frames.append((tb.tb_frame.f_code, tb.tb_lineno))
+            tb = tb.tb_next
+        return tuple(frames)
+
+    def _stack(self, tb):
+        if tb is None:
+            return ''
+        import traceback
+        return ('Traceback (most recent call last):\n' +
+                ''.join(traceback.format_list(traceback.extract_tb(tb))))
+
+    def format(self, exc_info):
+        """
+        Return the traceback of the exception except its last lines that
+        describe the exception, the ID of it, and the last lines, or None
+        if the traceback can't be cached.
+        """
+        import traceback
+        t, value, tb = exc_info
+        if value is None or hasattr(value, 'exceptions'):
+            # the exception groups have nested tracebacks
+            return None
+        chain = self._chain(value, tb)
+        # the descriptions of the chained exceptions are in the traceback
+        key = tuple((type(v), self._frames(v_tb),
+                     ''.join(traceback.format_exception_only(type(v), v)) if i else None,
+                     message)
+                    for i, (v, v_tb, message) in enumerate(reversed(chain)))
+        with self.lock:
+            cached = self.cache.pop(key, None)
+            if cached is not None:
+                self.cache[key] = cached
+        if cached is None:
+            parts = []
+            for v, v_tb, message in chain[:-1]:
+                parts.append(self._stack(v_tb))
+                parts.extend(traceback.format_exception_only(type(v), v))
+                parts.append(message)
+            parts.append(self._stack(tb))
+            stack = ''.join(parts)
+            cached = (stack, self.sha1(stack.encode('utf-8')).hexdigest()[:16])
+            with self.lock:
+                self.cache[key] = cached
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+        tail = ''.join(traceback.format_exception_only(t, value))
+        if tail[-1:] == '\n':
+            tail = tail[:-1]
+        return cached[0], cached[1], tail
+
+
+_tracebacks = _TracebackCache()
+
+
+def _formatsException(formatter):
+    # the formatters that format exceptions in their own way are left alone
+    formatter = formatter or logging._defaultFormatter
+    return type(formatter).formatException == logging.Formatter.formatException
+
+
+def _cacheTraceback(record, formatter):
+    """
+    Set the exc_text of the record from the traceback cache, and return
+    the traceback, its ID and the description of the exception.
+    """
+    if not record.exc_info or record.exc_text or not _formatsException(formatter):
+        return None
+    formatted = _tracebacks.format(record.exc_info)
+    if formatted:
+        record.exc_text = formatted[0] + formatted[2]
+    return formatted
+
+
+def _recordWithoutException(record):
+    copy = logging.makeLogRecord(record.__dict__)
+    copy.exc_info = None
+    copy.exc_text = None
+    return copy
+
+
+class _SideTable(object):
+    """
+    Table of the texts that log entities and messages refer to by their
+    IDs, such as the templates and the tracebacks, which are put only once.
+    """
+    CACHE_SIZE = 4096
+
+    def __init__(self, service, table, partition_key, property_name,
+                 resource_cache_dir=None, resource_cache_ttl=None):
+        self.service = service
+        self.table = table
+        self.partition_key = partition_key
+        self.property_name = property_name
+        self.resource_cache_dir = resource_cache_dir
+        self.resource_cache_ttl = resource_cache_ttl
+        # the IDs of the texts known to be in the table
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def put(self, text_id, text):
+        """
+        Put the text with the ID in the table unless it's already there.
+        """
+        if text_id in self.known:
+            return
+        entity = {'PartitionKey': self.partition_key,
+                  'RowKey': text_id,
+                  self.property_name: text}
+        _resources.call(('table', self.service.account_name, self.table),
+                        lambda: self.service.create_table(self.table),
+                        lambda: self.service.insert_or_replace_entity(self.table, entity),
+                        self.resource_cache_dir,
+                        self.resource_cache_ttl)
+        with self.lock:
+            if len(self.known) >= self.CACHE_SIZE:
+                self.known.clear()
+            self.known.add(text_id)
+
+
+class _Templates(object):
+    """
+    Templates of the log messages put in a table once, which are referred
+    to by their IDs, the hashes of the templates, along with the arguments
+    of the log messages in JSON.
+    """
+    CACHE_SIZE = 4096
+
+    def __init__(self, service, table, resource_cache_dir=None, resource_cache_ttl=None):
+        from hashlib import sha1
+        self.sha1 = sha1
+        self.table = _SideTable(service, table, TEMPLATE_PARTITION_KEY, 'template',
+                                resource_cache_dir, resource_cache_ttl)
+        # the IDs of the templates known to be in the table
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def encode(self, record):
+        """
+        Return the ID of the template of the record and the arguments
+        in JSON, or None if the log message can't be restored from them.
+        """
+        msg = record.msg
+        args = record.args
+        # the log messages without arguments may be formatted by the caller,
+        # which would put as many templates as the log messages
+        if not args or not isinstance(msg, _TEMPLATE_ARG_TYPES[0]):
+            return None
+        if record.exc_info or record.exc_text or getattr(record, 'stack_info', None):
+            return None
+        values = args.values() if isinstance(args, dict) else args
+        for value in values:
+            if not isinstance(value, _TEMPLATE_ARG_TYPES):
+                return None
+        template_id = self.ids.get(msg)
+        if template_id is None:
+            template_id = self._put(msg)
+        return template_id, json.dumps(args, separators=(',', ':'))
+
+    def _put(self, msg):
+        template_id = self.sha1(msg.encode('utf-8')).hexdigest()[:16]
+        self.table.put(template_id, msg)
+        with self.lock:
+            if len(self.ids) >= self.CACHE_SIZE:
+                self.ids.clear()
+            self.ids[msg] = template_id
+        return template_id
+
+
+def _templateFrame(handler, record):
+    """
+    Return the log text that the handler puts before and after the message
+    of the record, or None if it doesn't put the message exactly once.
+    """
+    copy = _recordWithoutException(record)
+    copy.msg = _MESSAGE_MARKER
+    copy.args = None
+    text = handler.format(copy)
+    if text.count(_MESSAGE_MARKER) != 1:
+        return None
+    head, _, tail = text.partition(_MESSAGE_MARKER)
+    return head, tail
+
+
+class BufferBudget(object):
+    """
+    Limit on the size of the output that all the handlers in the process
+    hold in memory before sending it to Azure Storage.
+    """
+    BLOCK = 'block'
+    DROP = 'drop'
+    SPILL = 'spill'
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.used = 0
+        self.dropped = 0
+        self.configure()
+
+    def configure(self,
+                  max_bytes=None,
+                  policy='block',
+                  timeout=1.0,
+                  spill_dir=None,
+                  priority_level=logging.ERROR):
+        """
+        Set the limit and the policy to apply when it is reached.
+        """
+        if policy not in (self.BLOCK, self.DROP, self.SPILL):
+            raise ValueError('Unknown policy: %r' % (policy,))
+        if policy == self.SPILL and not spill_dir:
+            raise ValueError('spill_dir is required for the spill policy')
+        with self.cond:
+            self.max_bytes = max_bytes
+            self.policy = policy
+            self.timeout = timeout
+            self.spill_dir = spill_dir
+            self.priority_level = priority_level
+            self.cond.notify_all()
+
+    def _fits(self, size):
+        return self.max_bytes is None or self.used + size <= self.max_bytes
+
+    def blocks(self, size):
+        """
+        Return True if reserving size bytes would wait for other output
+        to be sent.
+        """
+        with self.cond:
+            return self.policy == self.BLOCK and not self._fits(size)
+
+    def acquire(self, size, levelno=logging.NOTSET):
+        """
+        Reserve size bytes for output of the given level.
+
+        Return False if the output must not be held in memory, in which
+        case it's to be spilled to disk if spill_dir is set, or dropped.
+        Output at or above priority_level is always accepted.
+        """
+        with self.cond:
+            if not self._fits(size) and self.policy == self.BLOCK:
+                deadline = time.time() + (self.timeout or 0)
+                while not self._fits(size):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            if self._fits(size) or levelno >= self.priority_level:
+                self.used += size
+                return True
+            if self.policy != self.SPILL:
+                self.dropped += 1
+            return False
+
+    def release(self, size):
+        """
+        Give back the bytes reserved for output that has been sent.
+        """
+        if size:
+            with self.cond:
+                self.used -= size
+                self.cond.notify_all()
+
+
+_buffer_budget = BufferBudget()
+
+
+def set_buffer_budget(max_bytes=None,
+                      policy='block',
+                      timeout=1.0,
+                      spill_dir=None,
+                      priority_level=logging.ERROR):
+    """
+    Limit the size of the output that the handlers hold in memory.
+    """
+    _buffer_budget.configure(max_bytes=max_bytes,
+                             policy=policy,
+                             timeout=timeout,
+                             spill_dir=spill_dir,
+                             priority_level=priority_level)
+    return _buffer_budget
+
+
+# the handlers that may hold output to send to Azure Storage at exit
+_storage_handlers = weakref.WeakSet()
+
+# the timeout of shutdown() given by install_shutdown_hooks()
+_shutdown_timeout = None
+_shutdown_lock = threading.Lock()
+
+
+def shutdown(timeout=25.0, handlers=None):
+    """
+    Send the output held by the handlers, all the handlers by default,
+    to Azure Storage in parallel, the output of higher levels first,
+    within timeout seconds in total.
+
+    Return a list of pairs of the handler and the description of its
+    output that could not be sent, which is also written to stderr.
+    """
+    deadline = time.time() + timeout
+    if handlers is None:
+        handlers = _storage_handlers
+    handlers = sorted(handlers, key=lambda h: -h.level)
+    results = {}
+
+    def drain(handler):
+        try:
+            results[handler] = handler.drain(deadline)
+        except Exception as e:
+            results[handler] = 'failed: %s' % (e,)
+
+    threads = []
+    for handler in handlers:
+        t = threading.Thread(target=drain, args=(handler,))
+        t.daemon = True
+        t.start()
+        threads.append((handler, t))
+    undelivered = []
+    for handler, t in threads:
+        t.join(max(deadline - time.time(), 0))
+        if t.is_alive():
+            undelivered.append((handler, 'timed out'))
+        elif results.get(handler):
+            undelivered.append((handler, results[handler]))
+    for handler, description in undelivered:
+        sys.stderr.write('azure_storage_logging: %r could not send %s\n'
+                         % (handler, description))
+    return undelivered
+
+
+def _shutdownOnce():
+    global _shutdown_timeout
+    with _shutdown_lock:
+        timeout, _shutdown_timeout = _shutdown_timeout, None
+    if timeout is not None:
+        shutdown(timeout)
+
+
+def install_shutdown_hooks(timeout=25.0, signals=None):
+    """
+    Call shutdown() once at exit of the interpreter, or when the process
+    receives one of the signals, SIGTERM by default. This must be called
+    from the main thread.
+    """
+    import atexit
+    import signal
+    global _shutdown_timeout
+    _shutdown_timeout = timeout
+    # registered after the logging module, so called before logging.shutdown
+    atexit.register(_shutdownOnce)
+    if signals is None:
+        signals = (signal.SIGTERM,)
+
+    def handle(signum, frame):
+        _shutdownOnce()
+        previous = previous_handlers[signum]
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # terminate in the default way of the signal
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    previous_handlers = {}
+    for signum in signals:
+        previous_handlers[signum] = signal.signal(signum, handle)
+
+
+# properties of the log entities that pack many log records, which are
+# the number of the records and the chunks of the records in JSON
+# compressed in zlib format
+PACKED_COUNT_PROPERTY = 'packed_count'
+PACKED_CHUNK_PROPERTY = 'packed_%d'
+
+
+def _entitySize(entity):
+    size = 0
+    for name, value in entity.items():
+        value = getattr(value, 'value', value)
+        if isinstance(value, type(u'')):
+            size += len(name) + len(value.encode('utf-8'))
+        elif isinstance(value, bytes):
+            size += len(name) + len(value)
+        else:
+            size += len(name) + 8
+    return size
+
+
+class _SpillFile(object):
+    """
+    File to keep the output that exceeded the buffer budget until
+    it can be sent.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = False
+
+    def append(self, item):
+        import pickle
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+            self.pending = True
+
+    def drain(self):
+        """
+        Yield the spilled items in the order they were appended.
+        """
+        import pickle
+        draining = self.path + '.draining'
+        with self.lock:
+            if not os.path.exists(draining):
+                if not self.pending:
+                    return
+                os.rename(self.path, draining)
+            self.pending = False
+        with open(draining, 'rb') as f:
+            while True:
+                try:
+                    item = pickle.load(f)
+                except EOFError:
+                    break
+                yield item
+        os.remove(draining)
+
+
+class _MappedFile(object):
+    """
+    Read-only stream over a memory-mapped file, from which the blocks of
+    a blob are uploaded and the compressor is fed without buffered copies.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, f):
+        import mmap
+        self.size = os.fstat(f.fileno()).st_size
+        # an empty file can't be mapped
+        if self.size:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = None
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = max(0, min(size, self.size - self.pos))
+        data = self.map[self.pos:self.pos + size] if size else b''
+        self.pos += size
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def zipTo(self, f, file_path, arcname):
+        """
+        Write the file in zip format into f.
+        """
+        import zipfile
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+            if not hasattr(zipfile.ZipInfo, 'from_file'):
+                # writing an entry by chunks requires Python 3.6
+                z.write(file_path, arcname=arcname)
+                return
+            info = zipfile.ZipInfo.from_file(file_path, arcname)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            force_zip64 = info.file_size > zipfile.ZIP64_LIMIT
+            with z.open(info, 'w', force_zip64=force_zip64) as entry:
+                if self.map is None:
+                    return
+                view = memoryview(self.map)
+                try:
+                    for start in range(0, self.size, self.CHUNK_SIZE):
+                        entry.write(view[start:start + self.CHUNK_SIZE])
+                finally:
+                    view.release()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+# output formats of the log files shipped to blob storage
+OUTPUT_FORMATS = ('text', 'parquet')
+
+# columns of the log records in the parquet output format,
+# followed by the ones given by the columns parameter
+_PARQUET_COLUMNS = (
+    ('time', 'timestamp'),
+    ('level', 'string'),
+    ('logger', 'string'),
+    ('hostname', 'string'),
+    ('process', 'int32'),
+    ('message', 'string'),
+)
+
+# suffixes of the outdated log files named by rotation_filename(), which
+# may end with the counter added by _uniqueFilename()
+_ROTATED_SUFFIX_MATCH = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(\.\d+)?$')
 
 
 class _BlobStorageFileHandler(object):
+    """
+    Rotation and shipping of log files common to the handlers for
+    blob storage, which must precede the file handler in the bases.
+    """
+    # the time of the next rollover for the handlers that rotate by time
+    rolloverAt = None
+    # the size limit of the log file for the handlers that rotate by size
+    maxBytes = 0
+    # the number of bytes in the current log file, tracked by emit()
+    _bytes = 0
+    # the number of records in the current log file, or None if unknown
+    _records = None
+    # the last name given by rotation_filename() and its counter
+    _lastRotation = (None, 0)
 
     def __init__(self,
                   account_name=None,
@@ -49,54 +985,505 @@ class _BlobStorageFileHandler(object):
                   max_connections=1,
                   max_retries=5,
                   retry_wait=1.0,
-                  is_emulated=False):
+                  is_emulated=False,
+                  resource_cache_dir=None,
+                  resource_cache_ttl=3600,
+                  blob_name=None,
+                  manifest=None,
+                  output_format='text',
+                  columns=None,
+                  row_group_size=10000,
+                  upload_workers=0):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output_format: %r' % output_format)
+        self.output_format = output_format
+        self.columns = tuple(columns or ())
+        for column in self.columns:
+            if column in dict(_PARQUET_COLUMNS):
+                raise ValueError('column already exists: %r' % column)
+        self.row_group_size = row_group_size
+        from azure.storage.blob import BlockBlobService
         self.service = BlockBlobService(account_name=account_name,
                                         account_key=account_key,
                                         is_emulated=is_emulated,
                                         protocol=protocol)
-        self.container_created = False
-        hostname = gethostname()
-        self.meta = {'hostname': hostname.replace('_', '-'),
-                     'process': os.getpid()}
-        self.container = (container % self.meta).lower()
-        self.meta['hostname'] = hostname
+        self.blob_name = _NameTemplate(blob_name) if blob_name else None
+        self.manifest = _NameTemplate(manifest) if manifest else None
+        self.manifest_service = None
+        if manifest:
+            from azure.storage.blob import AppendBlobService
+            self.manifest_service = AppendBlobService(account_name=account_name,
+                                                      account_key=account_key,
+                                                      is_emulated=is_emulated,
+                                                      protocol=protocol)
+        # the numbers of records in the outdated log files not shipped yet
+        self.record_counts = {}
+        _storage_handlers.add(self)
+        self.meta = _Meta(process=os.getpid())
+        # only the %-style formats are expanded in the container
+        self.container = (container % _ContainerMeta(self.meta)).lower()
+        self.resource_cache_dir = resource_cache_dir
+        self.resource_cache_ttl = resource_cache_ttl
         self.zip_compression = zip_compression
         self.max_connections = max_connections
         self.max_retries = max_retries
         self.retry_wait = retry_wait
+        # the outdated log files not shipped yet, which are found by a scan
+        # of the directory for the first time and tracked by rotate() after
+        # that, and the ones being shipped or failed to be shipped by
+        # the upload workers since the last rollover
+        self.upload_workers = upload_workers
+        self.upload_cond = threading.Condition()
+        self.outdated = None
+        self.uploading = set()
+        self.upload_failed = set()
+        self.upload_threads = []
+        self.upload_process = None
+        self.upload_closed = False
 
-    def put_file_into_storage(self, dirName, fileName):
+    def _open(self):
+        stream = super(_BlobStorageFileHandler, self)._open()
+        self._bytes = os.fstat(stream.fileno()).st_size
+        # the records written before the handler opened the file are unknown
+        self._records = 0 if self._bytes == 0 else None
+        return stream
+
+    def _encode(self, msg):
         """
-        Ship the outdated log file to the specified blob container.
+        Return the formatted message terminated and encoded in the same
+        way as the stream does, or None if the stream takes no bytes.
+        """
+        if getattr(self.stream, 'buffer', None) is None:
+            return None
+        msg += getattr(self, 'terminator', '\n')
+        if os.linesep != '\n':
+            msg = msg.replace('\n', os.linesep)
+        return msg.encode(self.stream.encoding, self.stream.errors)
+
+    def _shouldRollover(self, record, size):
+        if self.rolloverAt is not None and record.created >= self.rolloverAt:
+            return True
+        # never rotate an empty file for a message larger than maxBytes
+        return (self.maxBytes > 0 and self._bytes > 0 and
+                self._bytes + size >= self.maxBytes)
+
+    def _formatRecord(self, record):
+        """
+        Format the record into a line of the log file, which is a line of
+        JSON that has the fields of the record in the parquet output format.
+        """
+        msg = self.format(record)
+        if self.output_format == 'text':
+            return msg
+        fields = {
+            'time': int(record.created * 1000),
+            'level': record.levelname,
+            'logger': record.name,
+            'hostname': self.meta['hostname'],
+            'process': record.process,
+            'message': msg,
+        }
+        for column in self.columns:
+            value = getattr(record, column, None)
+            fields[column] = None if value is None else '%s' % (value,)
+        return json.dumps(fields, sort_keys=True)
+
+    def shouldRollover(self, record):
+        """
+        Determine if rollover should occur, when the file reaches maxBytes
+        or the interval has passed.
+        """
+        if self.stream is None:
+            self.stream = self._open()
+        msg = self._formatRecord(record)
+        data = self._encode(msg)
+        return self._shouldRollover(record,
+                                    len(msg) + 1 if data is None else len(data))
+
+    def emit(self, record):
+        """
+        Emit a record.
+
+        Output the record to the file, catering for rollover as described
+        in doRollover(). The record is formatted only once, and the size
+        of the file is tracked from the output instead of the stream.
         """
-        if not self.container_created:
-            self.service.create_container(self.container)
-            self.container_created = True
-        fd, tmpfile_path = None, ''
         try:
-            file_path = os.path.join(dirName, fileName)
-            if self.zip_compression:
-                suffix, content_type = '.zip', 'application/zip'
-                fd, tmpfile_path = mkstemp(suffix=suffix)
-                with os.fdopen(fd, 'wb') as f:
-                    with ZipFile(f, 'w', ZIP_DEFLATED) as z:
-                        z.write(file_path, arcname=fileName)
-                file_path = tmpfile_path
+            record.hostname = self.meta['hostname']
+            msg = self._formatRecord(record)
+            if self.stream is None:
+                self.stream = self._open()
+            data = self._encode(msg)
+            size = len(msg) + 1 if data is None else len(data)
+            if self._shouldRollover(record, size):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                data = self._encode(msg)
+            if data is None:
+                self.stream.write(msg + getattr(self, 'terminator', '\n'))
             else:
-                suffix, content_type = '', 'text/plain'
-            self.service.create_blob_from_path(container_name=self.container,
-                                               blob_name=fileName+suffix,
-                                               file_path=file_path,
-                                               content_settings=ContentSettings(content_type=content_type),
-                                               max_connections=self.max_connections
-                                               )  # max_retries and retry_wait no longer arguments in azure 0.33
+                self.stream.buffer.write(data)
+            self._bytes += size
+            if self._records is not None:
+                self._records += 1
+            self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def rotation_filename(self, default_name=None):
+        """
+        Return the name of the outdated log file, which is suffixed with
+        the current time in UTC.
+        """
+        return self._uniqueFilename(
+            "%s.%s" % (self.baseFilename,
+                       datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')))
+
+    def _uniqueFilename(self, name):
+        """
+        Return the name of the outdated log file, suffixed with a counter
+        if the previous rollover took the name or the file exists, so that
+        no rollover overwrites the file or its blob shipped before.
+        """
+        lastName, count = self._lastRotation
+        count = count + 1 if name == lastName else 0
+        while os.path.exists(name if count == 0 else '%s.%d' % (name, count)):
+            count += 1
+        self._lastRotation = (name, count)
+        return name if count == 0 else '%s.%d' % (name, count)
+
+    def rotate(self, source, dest):
+        """
+        Rename the current log file to dest, and ship it to the blob
+        container along with the outdated log files that previous
+        rollovers failed to ship, or let the upload workers ship them.
+        """
+        # never overwrite an outdated log file which is not shipped yet
+        if os.path.exists(dest):
+            self._shipNow(dest)
+        if os.path.exists(source):
+            os.rename(source, dest)
+            self.record_counts[dest] = self._records
+            with self.upload_cond:
+                self._outdatedFiles().add(dest)
+        with self.upload_cond:
+            # retry the files that failed since the last rollover
+            self.upload_failed.clear()
+            self.upload_cond.notify_all()
+        if self.upload_workers:
+            self._startUploads()
+        else:
+            self.ship_outdated_files()
+
+    def _outdatedFiles(self):
+        """
+        Return the set of the outdated log files not shipped yet, with
+        the upload condition held.
+        """
+        if self.outdated is None:
+            dirName, baseName = os.path.split(self.baseFilename)
+            prefix = baseName + "."
+            plen = len(prefix)
+            self.outdated = set(os.path.join(dirName, fileName)
+                                for fileName in os.listdir(dirName)
+                                if fileName[:plen] == prefix and
+                                self.extMatch.match(fileName[plen:]))
+        return self.outdated
+
+    def _claimOldest(self):
+        """
+        Return the oldest outdated log file that nobody is shipping nor
+        failed to ship, marking it as being shipped, with the upload
+        condition held.
+        """
+        # the names of the files end with the time of their rotation
+        files = [path for path in self._outdatedFiles()
+                 if path not in self.uploading and path not in self.upload_failed]
+        if not files:
+            return None
+        path = min(files)
+        self.uploading.add(path)
+        return path
+
+    def _ship(self, path):
+        """
+        Ship the outdated log file marked as being shipped, and remove it.
+        """
+        try:
+            if os.path.exists(path):
+                dirName, fileName = os.path.split(path)
+                self.put_file_into_storage(dirName, fileName)
+                os.remove(path)
+            with self.upload_cond:
+                self.outdated.discard(path)
         finally:
-            if self.zip_compression and fd:
-                os.remove(tmpfile_path)
+            with self.upload_cond:
+                self.uploading.discard(path)
+                self.upload_cond.notify_all()
 
+    def _shipNow(self, path):
+        """
+        Ship the outdated log file in this thread, or wait for the upload
+        worker shipping it.
+        """
+        with self.upload_cond:
+            while path in self.uploading:
+                self.upload_cond.wait()
+            if not os.path.exists(path):
+                return
+            self._outdatedFiles().add(path)
+            self.uploading.add(path)
+        self._ship(path)
 
-class BlobStorageRotatingFileHandler(RotatingFileHandler,
-                                         _BlobStorageFileHandler):
+    def _startUploads(self):
+        """
+        Start the upload workers if they are not running in the process.
+        """
+        with self.upload_cond:
+            if self.upload_process == os.getpid():
+                return
+            self.upload_process = os.getpid()
+            self.upload_threads = []
+            for i in range(self.upload_workers):
+                t = threading.Thread(target=self._upload)
+                t.daemon = True
+                t.start()
+                self.upload_threads.append(t)
+
+    def _upload(self):
+        """
+        Ship the outdated log files, the oldest first, without holding
+        the handler lock.
+        """
+        while True:
+            with self.upload_cond:
+                path = self._claimOldest()
+                while path is None:
+                    if self.upload_closed:
+                        return
+                    self.upload_cond.wait()
+                    path = self._claimOldest()
+            try:
+                self._ship(path)
+            except Exception as e:
+                with self.upload_cond:
+                    self.upload_failed.add(path)
+                sys.stderr.write('azure_storage_logging: %r could not ship %s: %s\n'
+                                 % (self, path, e))
+
+    def ship_outdated_files(self):
+        """
+        Ship the outdated log files to the blob container, the oldest
+        first, and remove them from the local file system.
+        """
+        while True:
+            with self.upload_cond:
+                path = self._claimOldest()
+            if path is None:
+                break
+            self._ship(path)
+
+    def drain(self, deadline):
+        """
+        Ship the current log file along with the outdated ones to the blob
+        container before the deadline, and return the description of
+        the log files that could not be shipped, if any.
+        """
+        self.acquire()
+        try:
+            try:
+                if self._bytes > 0:
+                    self.doRollover()
+                elif self.upload_workers:
+                    self._startUploads()
+                else:
+                    self.ship_outdated_files()
+            except Exception:
+                pass
+        finally:
+            self.release()
+        with self.upload_cond:
+            if self.upload_workers:
+                self.upload_failed.clear()
+                self.upload_cond.notify_all()
+                # wait for the upload workers
+                while (self._outdatedFiles() - self.upload_failed and
+                       time.time() < deadline):
+                    self.upload_cond.wait(max(deadline - time.time(), 0))
+            left = len(self._outdatedFiles())
+        if left:
+            return '%d log files' % left
+        return None
+
+    def close(self):
+        """
+        Stop the upload workers once they have nothing to ship, and close
+        the handler.
+        """
+        with self.upload_cond:
+            self.upload_closed = True
+            self.upload_cond.notify_all()
+        super(_BlobStorageFileHandler, self).close()
+
+    def doRollover(self):
+        """
+        Do a rollover, and ship the outdated log file to the blob container.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        try:
+            self.rotate(self.baseFilename, self.rotation_filename())
+        finally:
+            if not self.delay:
+                self.stream = self._open()
+            if self.rolloverAt is not None:
+                currentTime = int(time.time())
+                newRolloverAt = self.computeRollover(currentTime)
+                while newRolloverAt <= currentTime:
+                    newRolloverAt = newRolloverAt + self.interval
+                self.rolloverAt = newRolloverAt
+
+    def _callWithContainer(self, func):
+        return _resources.call(('container', self.service.account_name, self.container),
+                               lambda: self.service.create_container(self.container),
+                               func,
+                               self.resource_cache_dir,
+                               self.resource_cache_ttl)
+
+    def put_file_into_storage(self, dirName, fileName):
+        """
+        Ship the outdated log file to the specified blob container.
+        """
+        file_path = os.path.join(dirName, fileName)
+        params = self._blobNameParams(file_path, fileName)
+        blobName = fileName
+        if self.blob_name:
+            blobName = self.blob_name.render(params)
+        with open(file_path, 'rb') as f:
+            source = _MappedFile(f)
+            try:
+                if self.output_format == 'parquet':
+                    blobName += '.parquet'
+                    size = self._putConverted(blobName,
+                                              'application/vnd.apache.parquet',
+                                              lambda tmp: self._writeParquet(f, tmp))
+                elif self.zip_compression:
+                    blobName += '.zip'
+                    size = self._putConverted(blobName,
+                                              'application/zip',
+                                              lambda tmp: source.zipTo(tmp, file_path, fileName))
+                else:
+                    self._putStream(blobName, source, 'text/plain')
+                    size = source.size
+                length = source.size
+            finally:
+                source.close()
+        records = self.record_counts.pop(file_path, None)
+        if self.manifest:
+            self._appendToManifest(self.manifest.render(params),
+                                   {'blob': blobName,
+                                    'size': size,
+                                    'length': length,
+                                    'records': records,
+                                    'hostname': params['hostname'],
+                                    'process': params['process'],
+                                    'modified': params['modified']})
+
+    def _putConverted(self, blobName, content_type, convert):
+        """
+        Put the outdated log file converted into a temporary file by
+        convert, and return the size of the blob.
+        """
+        from tempfile import TemporaryFile
+        with TemporaryFile() as tmp:
+            convert(tmp)
+            tmp.flush()
+            converted = _MappedFile(tmp)
+            try:
+                self._putStream(blobName, converted, content_type)
+                return converted.size
+            finally:
+                converted.close()
+
+    def _writeParquet(self, f, tmp):
+        """
+        Write the records in the log file f into tmp in parquet format.
+        """
+        from azure_storage_logging.columnar import write_parquet
+        schema = list(_PARQUET_COLUMNS) + [(c, 'string') for c in self.columns]
+
+        def rows():
+            f.seek(0)
+            for line in f:
+                try:
+                    fields = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # skip the line broken by a crash of the application
+                    continue
+                yield tuple(fields.get(name) for name, _ in schema)
+        write_parquet(tmp, schema, rows(), self.row_group_size)
+
+    def _blobNameParams(self, file_path, fileName):
+        """
+        Return the parameters to name the blob of the outdated log file,
+        with the date and time when the file was last modified in UTC.
+        """
+        modified = datetime.utcfromtimestamp(os.path.getmtime(file_path))
+        return _Meta(self.meta,
+                     filename=fileName,
+                     year=modified.strftime('%Y'),
+                     month=modified.strftime('%m'),
+                     day=modified.strftime('%d'),
+                     hour=modified.strftime('%H'),
+                     minute=modified.strftime('%M'),
+                     modified=modified.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def _appendToManifest(self, manifestName, entry):
+        """
+        Append the entry of the shipped log file to the manifest blob
+        in a line of JSON, creating the append blob if it doesn't exist.
+        """
+        service = self.manifest_service
+        line = json.dumps(entry, sort_keys=True) + '\n'
+
+        def create():
+            try:
+                # never truncate the manifest created by other handlers
+                service.create_blob(self.container, manifestName, if_none_match='*')
+            except Exception as e:
+                if getattr(e, 'status_code', None) != 409:
+                    raise
+
+        def append():
+            service.append_blob_from_text(self.container, manifestName, line)
+        _resources.call(('blob', service.account_name, self.container, manifestName),
+                        create,
+                        lambda: self._callWithContainer(append),
+                        self.resource_cache_dir,
+                        self.resource_cache_ttl)
+
+    def _putStream(self, blobName, stream, content_type):
+        from azure.storage.blob.models import ContentSettings
+        content_settings = ContentSettings(content_type=content_type)
+
+        def upload():
+            stream.seek(0)
+            self.service.create_blob_from_stream(container_name=self.container,
+                                                 blob_name=blobName,
+                                                 stream=stream,
+                                                 count=stream.size,
+                                                 content_settings=content_settings,
+                                                 max_connections=self.max_connections
+                                                 )  # max_retries and retry_wait no longer arguments in azure 0.33
+        self._callWithContainer(upload)
+
+
+class BlobStorageRotatingFileHandler(_BlobStorageFileHandler,
+                                     RotatingFileHandler):
     """
     Handler for logging to a file, which switches from one file
     to the next when the current file reaches a certain size.
@@ -104,6 +1491,8 @@ class BlobStorageRotatingFileHandler(RotatingFileHandler,
     The outdated log file is shipped to the specified Azure Storage
     blob container and removed from the local file system immediately.
     """
+    extMatch = _ROTATED_SUFFIX_MATCH
+
     def __init__(self,
                   filename,
                   mode='a',
@@ -118,8 +1507,16 @@ class BlobStorageRotatingFileHandler(RotatingFileHandler,
                   max_connections=1,
                   max_retries=5,
                   retry_wait=1.0,
-                  is_emulated=False):
-        meta = {'hostname': gethostname(), 'process': os.getpid()}
+                  is_emulated=False,
+                  resource_cache_dir=None,
+                  resource_cache_ttl=3600,
+                  blob_name=None,
+                  manifest=None,
+                  output_format='text',
+                  columns=None,
+                  row_group_size=10000,
+                  upload_workers=0):
+        meta = _Meta(process=os.getpid())
         RotatingFileHandler.__init__(self,
                                      filename % meta,
                                      mode=mode,
@@ -136,36 +1533,114 @@ class BlobStorageRotatingFileHandler(RotatingFileHandler,
                                          max_connections=max_connections,
                                          max_retries=max_retries,
                                          retry_wait=retry_wait,
-                                         is_emulated=is_emulated)
+                                         is_emulated=is_emulated,
+                                         resource_cache_dir=resource_cache_dir,
+                                         resource_cache_ttl=resource_cache_ttl,
+                                         blob_name=blob_name,
+                                         manifest=manifest,
+                                         output_format=output_format,
+                                         columns=columns,
+                                         row_group_size=row_group_size,
+                                         upload_workers=upload_workers)
+
+
+class BlobStorageTimedRotatingFileHandler(_BlobStorageFileHandler,
+                                          TimedRotatingFileHandler):
+    """
+    Handler for logging to a file, rotating the log file at certain timed
+    intervals.
+
+    The outdated log file is shipped to the specified Azure Storage
+    blob container and removed from the local file system immediately.
+    """
+    def __init__(self,
+                 filename,
+                 when='h',
+                 interval=1,
+                 encoding=None,
+                 delay=False,
+                 utc=False,
+                 account_name=None,
+                 account_key=None,
+                 protocol='https',
+                 container='logs',
+                 zip_compression=False,
+                 max_connections=1,
+                 max_retries=5,
+                 retry_wait=1.0,
+                 is_emulated=False,
+                 resource_cache_dir=None,
+                 resource_cache_ttl=3600,
+                 blob_name=None,
+                 manifest=None,
+                 output_format='text',
+                 columns=None,
+                 row_group_size=10000,
+                 upload_workers=0):
+        meta = _Meta(process=os.getpid())
+        TimedRotatingFileHandler.__init__(self,
+                                          filename % meta,
+                                          when=when,
+                                          interval=interval,
+                                          backupCount=1,
+                                          encoding=encoding,
+                                          delay=delay,
+                                          utc=utc)
+        _BlobStorageFileHandler.__init__(self,
+                                         account_name=account_name,
+                                         account_key=account_key,
+                                         protocol=protocol,
+                                         container=container,
+                                         zip_compression=zip_compression,
+                                         max_connections=max_connections,
+                                         max_retries=max_retries,
+                                         retry_wait=retry_wait,
+                                         is_emulated=is_emulated,
+                                         resource_cache_dir=resource_cache_dir,
+                                         resource_cache_ttl=resource_cache_ttl,
+                                         blob_name=blob_name,
+                                         manifest=manifest,
+                                         output_format=output_format,
+                                         columns=columns,
+                                         row_group_size=row_group_size,
+                                         upload_workers=upload_workers)
 
-    def doRollover(self):
+    def rotation_filename(self, default_name=None):
         """
-        Do a rollover, as described in __init__().
+        Return the name of the outdated log file, which is suffixed with
+        the start of the interval in the same way as TimedRotatingFileHandler.
         """
-        if self.stream:
-            self.stream.close()
-            self.stream = None
-        dfn = "%s.%s" % (self.baseFilename,
-                         datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S'))
-        if os.path.exists(self.baseFilename):
-            os.rename(self.baseFilename, dfn)
-            self.put_file_into_storage(*os.path.split(dfn))
-            os.remove(dfn)
-        if not self.delay:
-            self.stream = self._open()
+        currentTime = int(time.time())
+        t = self.rolloverAt - self.interval
+        if self.utc:
+            timeTuple = time.gmtime(t)
+        else:
+            timeTuple = time.localtime(t)
+            dstNow = time.localtime(currentTime)[-1]
+            dstThen = timeTuple[-1]
+            if dstNow != dstThen:
+                if dstNow:
+                    addend = 3600
+                else:
+                    addend = -3600
+                timeTuple = time.localtime(t + addend)
+        return self._uniqueFilename(
+            self.baseFilename + "." + time.strftime(self.suffix, timeTuple))
 
 
-class BlobStorageTimedRotatingFileHandler(TimedRotatingFileHandler,
-                                               _BlobStorageFileHandler):
+class BlobStorageSizedTimedRotatingFileHandler(_BlobStorageFileHandler,
+                                               TimedRotatingFileHandler):
     """
-    Handler for logging to a file, rotating the log file at certain timed
-    intervals.
+    Handler for logging to a file, which switches from one file
+    to the next when the current file reaches a certain size or
+    at certain timed intervals, whichever comes first.
 
     The outdated log file is shipped to the specified Azure Storage
     blob container and removed from the local file system immediately.
     """
     def __init__(self,
                  filename,
+                 maxBytes=0,
                  when='h',
                  interval=1,
                  encoding=None,
@@ -179,8 +1654,16 @@ class BlobStorageTimedRotatingFileHandler(TimedRotatingFileHandler,
                  max_connections=1,
                  max_retries=5,
                  retry_wait=1.0,
-                 is_emulated=False):
-        meta = {'hostname': gethostname(), 'process': os.getpid()}
+                 is_emulated=False,
+                 resource_cache_dir=None,
+                 resource_cache_ttl=3600,
+                 blob_name=None,
+                 manifest=None,
+                 output_format='text',
+                 columns=None,
+                 row_group_size=10000,
+                 upload_workers=0):
+        meta = _Meta(process=os.getpid())
         TimedRotatingFileHandler.__init__(self,
                                           filename % meta,
                                           when=when,
@@ -189,6 +1672,9 @@ class BlobStorageTimedRotatingFileHandler(TimedRotatingFileHandler,
                                           encoding=encoding,
                                           delay=delay,
                                           utc=utc)
+        self.maxBytes = maxBytes
+        # the outdated log files are suffixed as rotated by size
+        self.extMatch = _ROTATED_SUFFIX_MATCH
         _BlobStorageFileHandler.__init__(self,
                                          account_name=account_name,
                                          account_key=account_key,
@@ -198,35 +1684,274 @@ class BlobStorageTimedRotatingFileHandler(TimedRotatingFileHandler,
                                          max_connections=max_connections,
                                          max_retries=max_retries,
                                          retry_wait=retry_wait,
-                                         is_emulated=is_emulated)
+                                         is_emulated=is_emulated,
+                                         resource_cache_dir=resource_cache_dir,
+                                         resource_cache_ttl=resource_cache_ttl,
+                                         blob_name=blob_name,
+                                         manifest=manifest,
+                                         output_format=output_format,
+                                         columns=columns,
+                                         row_group_size=row_group_size,
+                                         upload_workers=upload_workers)
 
-    def emit(self, record):
+
+class _Stripe(object):
+    """
+    Storage account and queue or table of a stripe of a handler, which
+    backs off after the failures that may be caused by throttling.
+    """
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, service_class, settings, name_key, meta):
+        self.service_class = service_class
+        self.settings = settings
+        self.service = self.connect()
+        self.name = _NameTemplate(settings[name_key], _NAME_SANITIZERS.get(name_key))
+        # the name is resolved for every log record if it's dynamic
+        if self.name.dynamic:
+            self.resource = settings[name_key]
+        else:
+            self.resource = self.name.render(meta)
+        self.weight = settings.get('weight', 1)
+        if not self.weight > 0:
+            raise ValueError('weight of a stripe must be positive: %r' % (self.weight,))
+        self.failures = 0
+        self.backoff_until = 0
+
+    def connect(self, service_class=None):
         """
-        Emit a record.
+        Return a new service of the stripe, or of the service class
+        for the account of the stripe.
+        """
+        service_class = service_class or self.service_class
+        return service_class(account_name=self.settings['account_name'],
+                             account_key=self.settings['account_key'],
+                             is_emulated=self.settings['is_emulated'],
+                             protocol=self.settings['protocol'])
 
-        Output the record to the file, catering for rollover as described
-        in doRollover().
-        """
-        record.hostname = self.meta['hostname']
-        super(BlobStorageTimedRotatingFileHandler, self).emit(record)
-
-    def getFilesToDelete(self):
-        """
-        Determine the files to delete when rolling over.
-        """
-        dirName, baseName = os.path.split(self.baseFilename)
-        fileNames = os.listdir(dirName)
-        result = []
-        prefix = baseName + "."
-        plen = len(prefix)
-        for fileName in fileNames:
-            if fileName[:plen] == prefix:
-                suffix = fileName[plen:]
-                if self.extMatch.match(suffix):
-                    self.put_file_into_storage(dirName, fileName)
-                    result.append(os.path.join(dirName, fileName))
-        # delete the stored log file from the local file system immediately
-        return result
+    def resolve(self, record):
+        return self.name.resolve(record) if self.name.dynamic else self.resource
+
+    def healthy(self, now):
+        return now >= self.backoff_until
+
+    def succeeded(self):
+        if self.failures:
+            self.failures = 0
+            self.backoff_until = 0
+
+    def failed(self, error):
+        # the client errors don't tell anything about the health
+        status = getattr(error, 'status_code', None)
+        if status is not None and status < 500:
+            return
+        self.failures += 1
+        backoff = min(self.MAX_BACKOFF, 2 ** min(self.failures - 1, 16))
+        self.backoff_until = time.time() + backoff
+
+
+def _stripeSettings(stripes, defaults):
+    """
+    Return the settings of every stripe, which default to the settings
+    of the handler or the reader.
+    """
+    return [dict(defaults, **stripe) for stripe in stripes or [{}]]
+
+
+class _HashRing(object):
+    """
+    Consistent hash ring of the stripes, which has the points of every
+    stripe as many as its weight, and passes over the stripes backing
+    off after failures.
+    """
+    POINTS = 64
+
+    def __init__(self, stripes):
+        from hashlib import sha1
+        self.sha1 = sha1
+        self.stripes = stripes
+        points = []
+        for index, stripe in enumerate(stripes):
+            name = '%s/%s' % (stripe.settings['account_name'], stripe.resource)
+            # every stripe has at least a point, however light it is
+            for i in range(max(1, int(self.POINTS * stripe.weight))):
+                points.append((self._hash('%s#%d' % (name, i)), index))
+        points.sort()
+        self.hashes = [h for h, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def _hash(self, key):
+        return int(self.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def lookup(self, key):
+        """
+        Return the index of the stripe for the key.
+        """
+        start = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        now = time.time()
+        seen = set()
+        # walk the ring once at most
+        for i in range(start, start + len(self.hashes)):
+            index = self.indexes[i % len(self.hashes)]
+            if index in seen:
+                continue
+            if self.stripes[index].healthy(now):
+                return index
+            seen.add(index)
+            if len(seen) == len(self.stripes):
+                break
+        # all of the stripes are backing off
+        return self.indexes[start]
+
+
+def _snapshotRecord(record):
+    """
+    Return a shallow copy of the log record that is safe to format later
+    in another thread. The log message is resolved only if the arguments
+    may be mutable, and the exception is kept to be formatted later.
+    """
+    snapshot = record.__class__.__new__(record.__class__)
+    snapshot.__dict__.update(record.__dict__)
+    args = record.args
+    if args:
+        values = args.values() if isinstance(args, dict) else args
+        if (not isinstance(record.msg, _TEMPLATE_ARG_TYPES[0]) or
+                not isinstance(args, (tuple, dict)) or
+                not all(isinstance(value, _TEMPLATE_ARG_TYPES) for value in values)):
+            snapshot.msg = record.getMessage()
+            snapshot.args = None
+        elif isinstance(args, dict):
+            snapshot.args = dict(args)
+    elif not isinstance(record.msg, _TEMPLATE_ARG_TYPES[0]):
+        snapshot.msg = record.getMessage()
+    return snapshot
+
+
+def _snapshotSize(snapshot):
+    """
+    Return the estimated size of the message and the arguments in
+    the snapshot of the log record.
+    """
+    values = snapshot.args or ()
+    if isinstance(values, dict):
+        values = values.values()
+    return len(snapshot.msg) + sum(len(value) if isinstance(value, _TEMPLATE_ARG_TYPES[0])
+                                   else 8 for value in values)
+
+
+class _FormatWorker(object):
+    """
+    Background thread which formats and sends the snapshots of log
+    records that the handler appended, so that the logging threads only
+    append them to the deque. The snapshots are held within the buffer
+    budget until the worker takes them.
+    """
+    # the longest time that flushing the handler waits for the worker,
+    # the same as the default timeout of shutdown()
+    FLUSH_TIMEOUT = 25.0
+    def __init__(self, emit):
+        self.emit = emit
+        self.records = deque()
+        self.cond = threading.Condition()
+        # the worker is waiting for records, or sending ones
+        self.waiting = False
+        self.busy = False
+        self.closed = False
+        self.thread = None
+        self.process = None
+
+    def append(self, record):
+        """
+        Append the snapshot of the log record to be sent by the worker,
+        or emit the record in this thread if it's to be spilled.
+        """
+        if self.process != os.getpid():
+            self._start()
+        snapshot = _snapshotRecord(record)
+        size = _snapshotSize(snapshot)
+        if not _buffer_budget.acquire(size, record.levelno):
+            # the handler spills the output over the budget by itself
+            if _buffer_budget.policy == BufferBudget.SPILL:
+                self.emit(record)
+            return
+        self.records.append((snapshot, size))
+        if self.waiting:
+            with self.cond:
+                self.cond.notify_all()
+
+    def _start(self):
+        with self.cond:
+            if self.process == os.getpid():
+                return
+            # the records appended in the parent are sent by the parent
+            _buffer_budget.release(sum(size for _, size in self.records))
+            self.records.clear()
+            self.waiting = False
+            self.busy = False
+            self.process = os.getpid()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.waiting = True
+                while not self.records:
+                    self.busy = False
+                    # wake the threads waiting for the records to be sent
+                    self.cond.notify_all()
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                self.waiting = False
+                self.busy = True
+            while True:
+                try:
+                    record, size = self.records.popleft()
+                except IndexError:
+                    break
+                # the output of the record takes over the budget
+                _buffer_budget.release(size)
+                self.emit(record)
+
+    def wait(self, deadline=None):
+        """
+        Wait until the worker sends all of the appended records or the
+        deadline passes, and return True if it has sent them.
+        """
+        if self.process != os.getpid():
+            return True
+        with self.cond:
+            while self.records or self.busy:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        return False
+                    self.cond.wait(timeout)
+        return True
+
+    def flush(self, handler):
+        """
+        Wait for the worker to send the appended records up to
+        FLUSH_TIMEOUT seconds, and return True if it has sent them.
+        The records left are reported to stderr.
+        """
+        if self.wait(time.time() + self.FLUSH_TIMEOUT):
+            return True
+        sys.stderr.write('azure_storage_logging: %r could not send %d log records\n'
+                         % (handler, len(self.records)))
+        return False
+
+    def close(self):
+        """
+        Stop the worker once it sends all of the appended records.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
 
 class QueueStorageHandler(logging.Handler):
@@ -242,43 +1967,198 @@ class QueueStorageHandler(logging.Handler):
                  visibility_timeout=None,
                  base64_encoding=False,
                  is_emulated=False,
+                 resource_cache_dir=None,
+                 resource_cache_ttl=3600,
+                 compression_threshold=None,
+                 compression_dict=None,
+                 idempotent=False,
+                 serializer=None,
+                 stripes=None,
+                 template_table=None,
+                 traceback_table=None,
+                 defer_formatting=False,
                  ):
         """
         Initialize the handler.
         """
         logging.Handler.__init__(self)
-        self.service = QueueService(account_name=account_name,
-                                    account_key=account_key,
-                                    is_emulated=is_emulated,
-                                    protocol=protocol)
-        self.meta = {'hostname': gethostname(), 'process': os.getpid()}
-        self.queue = _formatName(queue, self.meta)
-        self.queue_created = False
+        from azure.storage.queue import QueueService
+        self.meta = _Meta(process=os.getpid())
+        settings = _stripeSettings(stripes, {'account_name': account_name,
+                                             'account_key': account_key,
+                                             'is_emulated': is_emulated,
+                                             'protocol': protocol,
+                                             'queue': queue})
+        self.stripes = [_Stripe(QueueService, s, 'queue', self.meta) for s in settings]
+        self.ring = _HashRing(self.stripes) if len(self.stripes) > 1 else None
+        self.service = self.stripes[0].service
+        self.queue_name = self.stripes[0].name
+        self.queue = self.stripes[0].resource
+        self.resource_cache_dir = resource_cache_dir
+        self.resource_cache_ttl = resource_cache_ttl
         self.message_ttl = message_ttl
         self.visibility_timeout = visibility_timeout
         self.base64_encoding = base64_encoding
+        if compression_threshold is not None:
+            self.compressor = _Compressor(compression_threshold, compression_dict)
+        else:
+            self.compressor = None
+        self.keys = _IdempotencyKeys(self.meta) if idempotent else None
+        if serializer is not None:
+            from azure_storage_logging.serializers import get_serializer
+            serializer = get_serializer(serializer)
+        self.serializer = serializer
+        self.templates = None
+        self.tracebacks = None
+        if template_table or traceback_table:
+            from azure.storage.table import TableService
+            table_service = self.stripes[0].connect(TableService)
+        if template_table:
+            self.templates = _Templates(table_service,
+                                        _formatName(template_table, self.meta),
+                                        resource_cache_dir,
+                                        resource_cache_ttl)
+        if traceback_table:
+            self.tracebacks = _SideTable(table_service,
+                                         _formatName(traceback_table, self.meta),
+                                         TRACEBACK_PARTITION_KEY,
+                                         'traceback',
+                                         resource_cache_dir,
+                                         resource_cache_ttl)
+        # the records are formatted and sent by the background worker
+        self.worker = _FormatWorker(self._send) if defer_formatting else None
+        _storage_handlers.add(self)
+
+    def drain(self, deadline):
+        """
+        Wait for the background worker to send the log messages before
+        the deadline, and return the description of the ones left, if any.
+        The handler holds no other output, since it sends every log message
+        as soon as it's formatted.
+        """
+        if self.worker and not self.worker.wait(deadline):
+            return '%d log messages' % len(self.worker.records)
+        return None
+
+    def flush(self):
+        """
+        Wait for the background worker to send the log messages, up to
+        its flush timeout.
+        """
+        if self.worker:
+            self.worker.flush(self)
+
+    def close(self):
+        """
+        Stop the background worker and close the handler.
+        """
+        if self.worker:
+            self.worker.close()
+        logging.Handler.close(self)
 
     def emit(self, record):
         """
         Emit a record.
 
-        Format the record and send it to the specified queue.
+        Format or serialize the record and send it to the specified queue,
+        or leave its snapshot to the background worker.
         """
+        if self.worker:
+            try:
+                self.worker.append(record)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.handleError(record)
+        else:
+            self._send(record)
+
+    def _send(self, record):
         try:
-            if not self.queue_created:
-                self.service.create_queue(self.queue)
-                self.queue_created = True
             record.hostname = self.meta['hostname']
-            msg = self._encode_text(self.format(record))
-            self.service.put_message(self.queue,
-                                     msg,
-                                     self.visibility_timeout,
-                                     self.message_ttl)
+            templated = None
+            if self.templates and not self.serializer and record.args:
+                frame = _templateFrame(self, record)
+                if frame:
+                    templated = self.templates.encode(record)
+            formatted = None
+            if not templated:
+                formatted = _cacheTraceback(record, self.formatter)
+            if templated:
+                # the log text around the message is kept along with
+                # the template ID and the arguments
+                head, tail = frame
+                text = '%s%s:%d:%d:%s%s%s' % (TEMPLATE_MESSAGE_PREFIX, templated[0],
+                                              len(head), len(tail), head, tail,
+                                              templated[1])
+            elif formatted and self.tracebacks and not self.serializer:
+                # the traceback is referred to by its ID, and put back
+                # after the log text of the given length
+                stack, traceback_id, tail = formatted
+                self.tracebacks.put(traceback_id, stack)
+                head = self.format(_recordWithoutException(record))
+                text = '%s%s:%d:%s\n%s' % (TRACEBACK_REFERENCE_PREFIX, traceback_id,
+                                          len(head), head, tail)
+            else:
+                if self.serializer:
+                    text = self.serializer(record)
+                else:
+                    text = self.format(record)
+                # the log text that looks like the ones above is escaped
+                if text.startswith(_RESERVED_PREFIXES):
+                    text = PLAIN_MESSAGE_PREFIX + text
+            msg = self._encode_text(self._compress_text(self._key_text(text)))
+            stripe = self._stripe()
+            queue = self.stripes[stripe].resolve(record)
+            service = self.stripes[stripe].service
+            self._callWithQueue(lambda: service.put_message(queue,
+                                                            msg,
+                                                            self.visibility_timeout,
+                                                            self.message_ttl),
+                                queue, stripe)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
+    def _stripe(self):
+        # the messages of a process go to the same stripe while it's healthy
+        if not self.ring:
+            return 0
+        return self.ring.lookup('%s|%d' % (self.meta['hostname'], os.getpid()))
+
+    def _callWithQueue(self, func, queue=None, stripe=0):
+        stripe = self.stripes[stripe]
+        queue = queue or stripe.resource
+        try:
+            result = _resources.call(('queue', stripe.service.account_name, queue),
+                                     lambda: stripe.service.create_queue(queue),
+                                     func,
+                                     self.resource_cache_dir,
+                                     self.resource_cache_ttl)
+        except Exception as e:
+            stripe.failed(e)
+            raise
+        stripe.succeeded()
+        return result
+
+    def _key_text(self, text):
+        # the idempotency key is put at the head of the text,
+        # so that it's compressed and encoded along with the text
+        if self.keys:
+            text = self.keys.next() + ' ' + text
+        return text
+
+    def _compress_text(self, text):
+        if self.compressor:
+            compressed = self.compressor.compress(text)
+            if compressed is not None:
+                encoded = COMPRESSED_MESSAGE_PREFIX + b64encode(compressed).decode('ascii')
+                # the compressed data gets larger in base64 with the prefix
+                if len(encoded) < len(text.encode('utf-8')):
+                    text = encoded
+        return text
+
     def _encode_text(self, text):
         if self.base64_encoding:
             text = b64encode(text.encode('utf-8')).decode('ascii')
@@ -289,11 +2169,76 @@ class QueueStorageHandler(logging.Handler):
         return text
 
 
+class _BatchController(object):
+    """
+    Controller of the effective batch size and linger time of a table
+    handler, which watches the arrival rate of the entities and the
+    latency of the batch commits to keep the delivery latency of the
+    entities within the target.
+    """
+    # number of the recent commits to estimate the latency from
+    WINDOW = 100
+    # weight of the latest interval in the average interval of the arrivals
+    ALPHA = 0.2
+
+    def __init__(self, max_size, max_linger, target_latency=None):
+        self.max_size = max_size
+        self.max_linger = max_linger
+        self.target_latency = target_latency
+        self.size = max_size
+        self.linger = max_linger
+        self.interval = None
+        self.last_arrival = None
+        self.latencies = deque(maxlen=self.WINDOW)
+
+    def arrived(self, now):
+        """
+        Update the arrival rate with an entity, with the pending lock held.
+        """
+        if self.last_arrival is not None:
+            interval = now - self.last_arrival
+            if self.interval is None:
+                self.interval = interval
+            else:
+                self.interval += self.ALPHA * (interval - self.interval)
+        self.last_arrival = now
+
+    def committed(self, latency):
+        """
+        Update the batch size and the linger time with the latency of a
+        batch commit. They are fixed if the target latency isn't given.
+        """
+        if self.target_latency is None:
+            return
+        self.latencies.append(latency)
+        latencies = sorted(self.latencies)
+        p99 = latencies[int(len(latencies) * 0.99)]
+        # the entities can wait for the batch for the rest of the target
+        linger = max(0.0, min(self.max_linger, self.target_latency - p99))
+        # and the batch is committed as soon as the entities expected to
+        # arrive in the meantime are there
+        if self.interval:
+            size = int(linger / self.interval) + 1
+        else:
+            size = self.max_size
+        self.size = max(2, min(self.max_size, size))
+        self.linger = linger
+
+
 class TableStorageHandler(logging.Handler):
     """
     Handler class which writes log messages to a Azure Storage table.
     """
     MAX_BATCH_SIZE = 100
+    # limit of the payload of a batch transaction, with room for Base64
+    # encoding of the binary properties and the overhead of the request
+    MAX_BATCH_BYTES = 2560 * 1024
+    # limits of the log records packed in a log entity before and
+    # after compression
+    MAX_PACK_BYTES = 512 * 1024
+    MAX_CHUNK_BYTES = 64 * 1024
+    # number of the recent milliseconds whose row numbers are kept
+    ROWNO_WINDOW = 1024
 
     def __init__(self, 
                  account_name=None,
@@ -305,31 +2250,70 @@ class TableStorageHandler(logging.Handler):
                  partition_key_formatter=None,
                  row_key_formatter=None,
                  is_emulated=False,
+                 resource_cache_dir=None,
+                 resource_cache_ttl=3600,
+                 compression_threshold=None,
+                 compression_dict=None,
+                 dead_letter_table=None,
+                 idempotent=False,
+                 immediate_level=None,
+                 linger=None,
+                 target_latency=None,
+                 stripes=None,
+                 template_table=None,
+                 traceback_table=None,
+                 pack_size=0,
+                 defer_formatting=False,
                  ):
         """
         Initialize the handler.
         """
         logging.Handler.__init__(self)
-        self.service = TableService(account_name=account_name,
-                                    account_key=account_key,
-                                    is_emulated=is_emulated,
-                                    protocol=protocol)
-        self.meta = {'hostname': gethostname(), 'process': os.getpid()}
-        self.table = _formatName(table, self.meta)
-        self.ready = False
-        self.rowno = 0
+        from azure.storage.table import TableService
+        self.meta = _Meta(process=os.getpid())
+        settings = _stripeSettings(stripes, {'account_name': account_name,
+                                             'account_key': account_key,
+                                             'is_emulated': is_emulated,
+                                             'protocol': protocol,
+                                             'table': table})
+        self.stripes = [_Stripe(TableService, s, 'table', self.meta) for s in settings]
+        self.ring = _HashRing(self.stripes) if len(self.stripes) > 1 else None
+        self.service = self.stripes[0].service
+        self.table_name = self.stripes[0].name
+        self.table = self.stripes[0].resource
+        if dead_letter_table:
+            self.dead_letter_table = _formatName(dead_letter_table, self.meta)
+        else:
+            self.dead_letter_table = None
+        self.templates = None
+        if template_table:
+            self.templates = _Templates(self.service,
+                                        _formatName(template_table, self.meta),
+                                        resource_cache_dir,
+                                        resource_cache_ttl)
+        self.tracebacks = None
+        if traceback_table:
+            self.tracebacks = _SideTable(self.service,
+                                         _formatName(traceback_table, self.meta),
+                                         TRACEBACK_PARTITION_KEY,
+                                         'traceback',
+                                         resource_cache_dir,
+                                         resource_cache_ttl)
+        self.resource_cache_dir = resource_cache_dir
+        self.resource_cache_ttl = resource_cache_ttl
+        if compression_threshold is not None:
+            self.compressor = _Compressor(compression_threshold, compression_dict)
+        else:
+            self.compressor = None
+        # the next row numbers of the recent milliseconds
+        self.rownos = OrderedDict()
+        self.keys = _IdempotencyKeys(self.meta) if idempotent else None
         if not partition_key_formatter:
             # default format for partition keys
             fmt = '%(asctime)s'
             datefmt = '%Y%m%d%H%M'
             partition_key_formatter = logging.Formatter(fmt, datefmt)
         self.partition_key_formatter = partition_key_formatter
-        if not row_key_formatter:
-            # default format for row keys
-            fmt = '%(asctime)s%(msecs)03d-%(hostname)s-%(process)d-%(rowno)02d'
-            datefmt = '%Y%m%d%H%M%S'
-            row_key_formatter = logging.Formatter(fmt, datefmt)
-        self.row_key_formatter = row_key_formatter
         # extra properties and formatters for them
         self.extra_properties = extra_properties
         if extra_properties:
@@ -344,15 +2328,54 @@ class TableStorageHandler(logging.Handler):
                 self.extra_property_names[extra] = self._getFormatName(extra)
         # the storage emulator doesn't support batch operations
         if batch_size <= 1 or is_emulated:
-            self.batch = None
+            self.batch_size = 0
+        elif batch_size > TableStorageHandler.MAX_BATCH_SIZE:
+            self.batch_size = TableStorageHandler.MAX_BATCH_SIZE
         else:
-            self.batch = TableBatch()
-            if batch_size > TableStorageHandler.MAX_BATCH_SIZE:
-                self.batch_size = TableStorageHandler.MAX_BATCH_SIZE
+            self.batch_size = batch_size
+        # the log records packed in a log entity, which require batches
+        self.pack_size = pack_size if self.batch_size and pack_size > 1 else 0
+        if not row_key_formatter:
+            # default format for row keys, whose row number is wider for
+            # the packed entities that number more records in a millisecond
+            if self.keys:
+                fmt = '%(asctime)s%(msecs)03d-%(idempotency_key)s'
+            elif self.pack_size:
+                fmt = '%(asctime)s%(msecs)03d-%(hostname)s-%(process)d-%(rowno)04d'
             else:
-                self.batch_size = batch_size
-        if self.batch:
-            self.current_partition_key = None
+                fmt = '%(asctime)s%(msecs)03d-%(hostname)s-%(process)d-%(rowno)02d'
+            datefmt = '%Y%m%d%H%M%S'
+            row_key_formatter = logging.Formatter(fmt, datefmt)
+        self.row_key_formatter = row_key_formatter
+        # the entities waiting for the next batch, which are swapped out
+        # under the lock and committed by the thread that swapped them out
+        self.pending_lock = threading.Condition()
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        # the batch is committed by the linger thread if its first entity
+        # has waited for the linger time, and the batch size and the linger
+        # time are tuned to the target latency if it's given
+        self.controller = None
+        if self.batch_size and (linger is not None or target_latency is not None):
+            if linger is None:
+                linger = target_latency
+            self.controller = _BatchController(self.batch_size, linger, target_latency)
+        self.linger_thread = None
+        self.linger_process = None
+        self.closed = False
+        self.spill = None
+        self.spill_lock = threading.Lock()
+        # the records at the immediate level or above are sent at once
+        # on a connection of their own, bypassing the batch
+        self.immediate_level = None
+        if self.batch_size and immediate_level is not None:
+            self.immediate_level = logging._checkLevel(immediate_level)
+            for stripe in self.stripes:
+                stripe.immediate_service = stripe.connect()
+        # the records are formatted and written by the background worker
+        self.worker = _FormatWorker(self._write) if defer_formatting else None
+        _storage_handlers.add(self)
 
     def _copyLogRecord(self, record):
         copy = logging.makeLogRecord(record.__dict__)
@@ -362,6 +2385,44 @@ class TableStorageHandler(logging.Handler):
             copy.stack_info = None
         return copy
 
+    def _nextRowno(self, record):
+        """
+        Return the row number of the record, which increases in every
+        millisecond of the time of the records, with the pending lock held.
+        """
+        ms = (int(record.created), int(record.msecs))
+        rowno = self.rownos.pop(ms, 0)
+        self.rownos[ms] = rowno + 1
+        # a record is unlikely to come after the records of ROWNO_WINDOW
+        # later milliseconds
+        if len(self.rownos) > self.ROWNO_WINDOW:
+            self.rownos.popitem(last=False)
+        return rowno
+
+    def _stripe(self, partition_key):
+        # the entities in a partition of a process go to the same stripe
+        # while it's healthy, so that they are still batched together
+        if not self.ring:
+            return 0
+        return self.ring.lookup('%s|%d|%s' % (self.meta['hostname'],
+                                              os.getpid(),
+                                              partition_key))
+
+    def _callWithTable(self, func, table=None, stripe=0):
+        stripe = self.stripes[stripe]
+        table = table or stripe.resource
+        try:
+            result = _resources.call(('table', stripe.service.account_name, table),
+                                     lambda: stripe.service.create_table(table),
+                                     func,
+                                     self.resource_cache_dir,
+                                     self.resource_cache_ttl)
+        except Exception as e:
+            stripe.failed(e)
+            raise
+        stripe.succeeded()
+        return result
+
     def _getFormatName(self, extra):
         name = extra
         style = extra[0]
@@ -376,26 +2437,60 @@ class TableStorageHandler(logging.Handler):
                     name = name[1:-1]
         return name
 
+    def _setMessage(self, entity, message):
+        # the packed log records are compressed together
+        if self.compressor and not self.pack_size:
+            compressed = self.compressor.compress(message)
+            if compressed is not None:
+                from azure.storage.table.models import EdmType, EntityProperty
+                entity['message'] = EntityProperty(EdmType.BINARY, compressed)
+                entity['message_encoding'] = COMPRESSED_MESSAGE_ENCODING
+                return
+        entity['message'] = message
+
+    def handle(self, record):
+        """
+        Conditionally emit the specified logging record.
+
+        Unlike logging.Handler, the handler lock is not held while emitting
+        the record, so that logging threads don't wait for each other's
+        formatting and network I/O. The shared state of the batch is only
+        updated under a short lock in emit().
+        """
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
     def emit(self, record):
         """
         Emit a record.
 
-        Format the record and send it to the specified table.
+        Format the record and send it to the specified table, or leave
+        its snapshot to the background worker.
         """
+        if self.worker:
+            try:
+                self.worker.append(record)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.handleError(record)
+        else:
+            self._write(record)
+
+    def _write(self, record):
         try:
-            if not self.ready:
-                self.service.create_table(self.table)
-                self.ready = True
             # generate partition key for the entity
             record.hostname = self.meta['hostname']
             copy = self._copyLogRecord(record)
+            if self.keys:
+                copy.idempotency_key = self.keys.next()
             partition_key = self.partition_key_formatter.format(copy)
-            # ensure entities in the batch all have the same patition key
-            if self.batch:
-                if self.current_partition_key is not None:
-                    if partition_key != self.current_partition_key:
-                        self.flush()
-                self.current_partition_key = partition_key
+            stripe = self._stripe(partition_key)
+            table = self.stripes[stripe].resolve(record)
             # add log message and extra properties to the entity
             entity = {}
             if self.extra_properties:
@@ -403,21 +2498,78 @@ class TableStorageHandler(logging.Handler):
                     formatter = self.extra_property_formatters[extra]
                     name = self.extra_property_names[extra]
                     entity[name] = formatter.format(copy)
-            entity['message'] = self.format(record)
-            # generate row key for the entity
-            copy.rowno = self.rowno
-            row_key = self.row_key_formatter.format(copy)
-            # add entitiy to the table
-            entity['PartitionKey'] = partition_key
-            entity['RowKey'] = row_key
-            if not self.batch:
-                self.service.insert_or_replace_entity(self.table, entity)
+            templated = None
+            if self.templates and record.args:
+                frame = _templateFrame(self, record)
+                if frame:
+                    templated = self.templates.encode(record)
+            formatted = None
+            if not templated:
+                formatted = _cacheTraceback(record, self.formatter)
+            if templated:
+                # the log text around the message is kept along with
+                # the template ID and the arguments
+                entity['template_id'], entity['args'] = templated
+                entity['template_head'], entity['template_tail'] = frame
+            elif formatted and self.tracebacks:
+                # the traceback is referred to by its ID
+                stack, entity['traceback_id'], entity['exception'] = formatted
+                self.tracebacks.put(entity['traceback_id'], stack)
+                self._setMessage(entity, self.format(_recordWithoutException(record)))
             else:
-                self.batch.insert_or_replace_entity(entity)
-                # commit the ongoing batch if it reaches the high mark
-                self.rowno += 1
-                if self.rowno >= self.batch_size:
-                    self.flush()
+                self._setMessage(entity, self.format(record))
+            entity['PartitionKey'] = partition_key
+            if not self.batch_size:
+                # generate row key and add entitiy to the table
+                with self.pending_lock:
+                    copy.rowno = self._nextRowno(copy)
+                entity['RowKey'] = self.row_key_formatter.format(copy)
+                service = self.stripes[stripe].service
+                self._callWithTable(lambda: service.insert_or_replace_entity(table, entity),
+                                    table, stripe)
+                return
+            if self.immediate_level is not None and record.levelno >= self.immediate_level:
+                with self.pending_lock:
+                    # generate row key in the same sequence as the batch
+                    copy.rowno = self._nextRowno(copy)
+                    entity['RowKey'] = self.row_key_formatter.format(copy)
+                service = self.stripes[stripe].immediate_service
+                self._callWithTable(lambda: service.insert_or_replace_entity(table, entity),
+                                    table, stripe)
+                return
+            size = _entitySize(entity)
+            if self.pending and _buffer_budget.blocks(size):
+                # commit the own pending entities rather than waiting for
+                # the other threads to commit theirs
+                with self.pending_lock:
+                    since = self.pending_since
+                    entities, released = self._swapPending()
+                self._commitPending(entities, released, since)
+            accepted = _buffer_budget.acquire(size, record.levelno)
+            entities = None
+            with self.pending_lock:
+                # generate row key unique in the millisecond
+                copy.rowno = self._nextRowno(copy)
+                entity['RowKey'] = self.row_key_formatter.format(copy)
+                if accepted:
+                    self.pending.append((stripe, table, entity, record.levelno))
+                    self.pending_bytes += size
+                    if self.controller:
+                        now = time.time()
+                        self.controller.arrived(now)
+                        if self.pending_since is None:
+                            self.pending_since = now
+                            self._startLinger()
+                            self.pending_lock.notify()
+                # swap out the ongoing batch if it reaches the high mark
+                batch_size = self.controller.size if self.controller else self.batch_size
+                if len(self.pending) >= batch_size * (self.pack_size or 1):
+                    since = self.pending_since
+                    entities, size = self._swapPending()
+            if not accepted and _buffer_budget.spill_dir:
+                self._spillEntity(stripe, table, entity)
+            if entities is not None:
+                self._commitPending(entities, size, since)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -425,14 +2577,322 @@ class TableStorageHandler(logging.Handler):
 
     def flush(self):
         """
-        Ensure all logging output has been flushed.
+        Ensure all logging output has been flushed, waiting for the
+        background worker up to its flush timeout.
+        """
+        if self.worker:
+            self.worker.flush(self)
+        if self.batch_size:
+            with self.pending_lock:
+                entities, size = self._swapPending()
+            self._commitPending(entities, size)
+            self._commitSpilled()
+
+    def _swapPending(self):
+        """
+        Take out the pending entities and their size, with the lock held.
+        """
+        entities, size = self.pending, self.pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        return entities, size
+
+    def _startLinger(self):
+        """
+        Start the linger thread if it's not running in the process, with
+        the pending lock held.
+        """
+        if self.linger_process == os.getpid() and self.linger_thread.is_alive():
+            return
+        self.linger_process = os.getpid()
+        self.linger_thread = threading.Thread(target=self._linger)
+        self.linger_thread.daemon = True
+        self.linger_thread.start()
+
+    def _linger(self):
+        """
+        Commit the batch whose first entity has waited for the linger time.
+        """
+        while True:
+            with self.pending_lock:
+                if self.closed:
+                    return
+                if self.pending_since is None:
+                    self.pending_lock.wait()
+                    continue
+                since = self.pending_since
+                wait = since + self.controller.linger - time.time()
+                if wait > 0:
+                    self.pending_lock.wait(wait)
+                    continue
+                entities, size = self._swapPending()
+            try:
+                self._commitPending(entities, size, since)
+            except Exception as e:
+                # the failure isn't related to the record being logged
+                sys.stderr.write('azure_storage_logging: %r could not commit '
+                                 'a batch: %s\n' % (self, e))
+
+    def _groupPending(self, entities):
+        """
+        Return the stripe, the table and the entities for every stripe,
+        table and partition key in the pending entities, in the order
+        they appear.
+        """
+        partitions = {}
+        order = []
+        for stripe, table, entity, _ in entities:
+            key = (stripe, table, entity['PartitionKey'])
+            if key not in partitions:
+                partitions[key] = []
+                order.append(key)
+            partitions[key].append(entity)
+        return [(key[0], key[1], partitions[key]) for key in order]
+
+    def _commitPending(self, entities, size, since=None):
+        """
+        Commit the entities taken out of the pending ones, in a batch for
+        every table and partition key, outside the lock.
         """
-        if self.batch and self.rowno > 0:
+        start = time.time()
+        try:
+            for stripe, table, group in self._groupPending(entities):
+                self._commitEntities(group, table, stripe)
+        finally:
+            _buffer_budget.release(size)
+        if self.controller and since is not None:
+            with self.pending_lock:
+                self.controller.committed(time.time() - start)
+        # the table takes entities again, so the spilled ones follow them
+        if entities:
+            self._commitSpilled()
+
+    def _commitSpilled(self):
+        """
+        Commit the spilled entities, if any, unless another thread is
+        committing them.
+        """
+        # only a thread at a time drains the spilled entities
+        if self.spill and self.spill_lock.acquire(False):
             try:
-                self.service.commit_batch(self.table, self.batch)
+                self._commitSpilledEntities()
             finally:
-                self.rowno = 0
-                self.batch = TableBatch()
+                self.spill_lock.release()
+
+    def drain(self, deadline):
+        """
+        Commit the pending entities, the ones of higher levels first, and
+        the spilled ones before the deadline, and return the description
+        of the entities that could not be committed, if any.
+        """
+        if self.worker and not self.worker.wait(deadline):
+            # the records left to the background worker are not committed
+            left = len(self.worker.records)
+            if not self.batch_size:
+                return '%d log records' % left
+        else:
+            left = 0
+        if not self.batch_size:
+            return None
+        with self.pending_lock:
+            entities, size = self._swapPending()
+        entities.sort(key=lambda item: -item[3])
+        undelivered = 0
+        try:
+            for stripe, table, group in self._groupPending(entities):
+                if time.time() >= deadline:
+                    undelivered += len(group)
+                    continue
+                try:
+                    self._commitEntities(group, table, stripe)
+                except Exception:
+                    undelivered += len(group)
+        finally:
+            _buffer_budget.release(size)
+        spilled = False
+        if self.spill and self.spill.pending:
+            spilled = True
+            if time.time() < deadline and self.spill_lock.acquire(False):
+                try:
+                    self._commitSpilledEntities()
+                    spilled = False
+                except Exception:
+                    pass
+                finally:
+                    self.spill_lock.release()
+        if undelivered or spilled or left:
+            description = '%d entities' % undelivered
+            if left:
+                description += ' and %d log records' % left
+            if spilled:
+                description += ' and the spilled entities in %s' % self.spill.path
+            return description
+        return None
+
+    def close(self):
+        """
+        Stop the linger thread and the background worker, and close
+        the handler.
+        """
+        if self.worker:
+            self.worker.close()
+        with self.pending_lock:
+            self.closed = True
+            self.pending_lock.notify()
+        logging.Handler.close(self)
+
+    def _spillEntity(self, stripe, table, entity):
+        with self.pending_lock:
+            if not self.spill:
+                # the table may be a template for dynamic tables
+                table_name = re.sub(r'[^\w-]', '_', self.table)
+                name = '%s.%d.%d.spill' % (table_name, os.getpid(), id(self))
+                self.spill = _SpillFile(os.path.join(_buffer_budget.spill_dir, name))
+        self.spill.append((stripe, table, entity))
+
+    def _commitEntities(self, entities, table=None, stripe=0):
+        """
+        Commit the entities of a partition in batch transactions, packing
+        the log records in the entities if the handler does.
+        """
+        if self.pack_size:
+            entities = self._packEntities(entities)
+        batch = []
+        size = 0
+        for entity in entities:
+            entity_size = _entitySize(entity)
+            if batch and (len(batch) >= self.MAX_BATCH_SIZE or
+                          size + entity_size > self.MAX_BATCH_BYTES):
+                self._commitBatch(batch, table, stripe)
+                batch = []
+                size = 0
+            batch.append(entity)
+            size += entity_size
+        if batch:
+            self._commitBatch(batch, table, stripe)
+
+    def _packEntities(self, entities):
+        """
+        Return the entities that pack the log records of the entities,
+        up to pack_size records each, in the order of them.
+        """
+        packed = []
+        records = []
+        size = 0
+        for entity in entities:
+            record = dict((k, v) for k, v in entity.items() if k != 'PartitionKey')
+            text = json.dumps(record, default=str, separators=(',', ':'))
+            if records and (len(records) >= self.pack_size or
+                            size + len(text) > self.MAX_PACK_BYTES):
+                packed.append(self._packedEntity(first, last, records))
+                records = []
+                size = 0
+            if not records:
+                first = entity
+            last = entity
+            records.append(text)
+            size += len(text) + 1
+        if records:
+            packed.append(self._packedEntity(first, last, records))
+        return packed
+
+    def _packedEntity(self, first, last, records):
+        import zlib
+        from azure.storage.table.models import EdmType, EntityProperty
+        data = zlib.compress(('[%s]' % ','.join(records)).encode('utf-8'))
+        # the entity is keyed by the range of the row keys of the records
+        entity = {'PartitionKey': first['PartitionKey'],
+                  'RowKey': first['RowKey'],
+                  'last_row_key': last['RowKey'],
+                  PACKED_COUNT_PROPERTY: len(records)}
+        for i in range(0, len(data), self.MAX_CHUNK_BYTES):
+            chunk = data[i:i + self.MAX_CHUNK_BYTES]
+            entity[PACKED_CHUNK_PROPERTY % (i // self.MAX_CHUNK_BYTES)] = \
+                EntityProperty(EdmType.BINARY, chunk)
+        return entity
+
+    def _commitBatch(self, entities, table=None, stripe=0):
+        """
+        Commit the entities in a batch transaction. If an entity makes
+        the batch fail, put it in the dead-letter table or drop it, and
+        commit the rest in a new batch.
+        """
+        from azure.storage.table import TableBatch
+        table = table or self.stripes[stripe].resource
+        service = self.stripes[stripe].service
+        while entities:
+            batch = TableBatch()
+            for entity in entities:
+                batch.insert_or_replace_entity(entity)
+            try:
+                self._callWithTable(lambda: service.commit_batch(table, batch), table, stripe)
+                return
+            except Exception as e:
+                index = _failedOperationIndex(e)
+                if index is None or index >= len(entities):
+                    raise
+                self._putDeadLetter(entities[index], e, table, stripe)
+                entities = entities[:index] + entities[index+1:]
+
+    def _putDeadLetter(self, entity, error, source, stripe=0):
+        """
+        Put the entity that failed in the dead-letter table of the stripe
+        along with the error and the source table, or drop it if there's
+        no dead-letter table.
+        """
+        if not self.dead_letter_table:
+            return
+        table = self.dead_letter_table
+        service = self.stripes[stripe].service
+        error = ('%s' % (error,))[:1024]
+        dead_letter = dict(entity, error=error, table=source)
+        try:
+            self._callWithTable(lambda: service.insert_or_replace_entity(table, dead_letter),
+                                table, stripe)
+        except Exception:
+            # the entity itself may be invalid, keep only its keys and the error
+            message = getattr(entity.get('message'), 'value', entity.get('message'))
+            dead_letter = {'PartitionKey': entity['PartitionKey'],
+                           'RowKey': entity['RowKey'],
+                           'error': error,
+                           'table': source}
+            if isinstance(message, type(u'')):
+                dead_letter['message'] = message[:1024]
+            try:
+                self._callWithTable(lambda: service.insert_or_replace_entity(table, dead_letter),
+                                    table, stripe)
+            except Exception:
+                pass
+
+    def _commitSpilledEntities(self):
+        entities = self.spill.drain()
+        # the group being committed, and the one that the items taken
+        # from the spill file are gathered in
+        committing = []
+        group = []
+        try:
+            for item in entities:
+                if group and (len(group) >= self.batch_size * (self.pack_size or 1) or
+                              item[:2] != group[0][:2] or
+                              item[2]['PartitionKey'] != group[0][2]['PartitionKey']):
+                    committing, group = group, [item]
+                    self._commitEntities([entity for _, _, entity in committing],
+                                         committing[0][1], committing[0][0])
+                    committing = []
+                else:
+                    group.append(item)
+            if group:
+                committing, group = group, []
+                self._commitEntities([entity for _, _, entity in committing],
+                                     committing[0][1], committing[0][0])
+        except Exception:
+            # keep the entities not committed yet for the next time
+            for entity in committing + group:
+                self.spill.append(entity)
+            for entity in entities:
+                self.spill.append(entity)
+            raise
 
     def setFormatter(self, fmt):
         """
@@ -462,3 +2922,185 @@ class TableStorageHandler(logging.Handler):
         Set the row key formatter.
         """
         self.row_key_formatter = fmt
+
+
+class RingBufferHandler(MemoryHandler):
+    """
+    Handler class which keeps the last log records of every thread or
+    request in memory, and passes them to the target handler only when
+    a log record at the flush level or above arrives.
+    """
+    def __init__(self,
+                 capacity=100,
+                 flushLevel=logging.ERROR,
+                 target=None,
+                 max_age=None,
+                 key_attribute=None,
+                 max_keys=1024,
+                 ):
+        """
+        Initialize the handler.
+        """
+        MemoryHandler.__init__(self, capacity, logging._checkLevel(flushLevel),
+                               target)
+        self.max_age = max_age
+        self.key_attribute = key_attribute
+        self.max_keys = max_keys
+        # ring buffers of the threads or the requests, least recently used first
+        self.buffers = OrderedDict()
+        self.buffers_lock = threading.Lock()
+
+    def handle(self, record):
+        """
+        Conditionally emit the specified logging record.
+
+        The handler lock is not held while emitting the record, so that
+        logging threads don't wait for the target handler passing on the
+        buffered records of another thread.
+        """
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+    def _key(self, record):
+        if self.key_attribute:
+            key = getattr(record, self.key_attribute, None)
+            if key is not None:
+                return key
+        return record.thread
+
+    def _compactLogRecord(self, record):
+        # keep the formatted message and traceback rather than the arguments
+        # and the frames, which may hold a lot of memory
+        copy = logging.makeLogRecord(record.__dict__)
+        copy.msg = record.getMessage()
+        copy.args = None
+        if record.exc_info and not record.exc_text:
+            formatter = self.formatter or logging._defaultFormatter
+            copy.exc_text = formatter.formatException(record.exc_info)
+        copy.exc_info = None
+        return copy
+
+    def emit(self, record):
+        """
+        Emit a record.
+
+        Append the record to the ring buffer of its thread or request, or
+        pass the buffered records and the record to the target handler if
+        the record is at the flush level or above.
+        """
+        try:
+            key = self._key(record)
+            records = None
+            with self.buffers_lock:
+                buf = self.buffers.pop(key, None)
+                if self.shouldFlush(record):
+                    records = list(buf or ())
+                else:
+                    if buf is None:
+                        buf = deque(maxlen=self.capacity)
+                    buf.append(self._compactLogRecord(record))
+                    self.buffers[key] = buf
+                    while len(self.buffers) > self.max_keys:
+                        self.buffers.popitem(last=False)
+            if records is None:
+                return
+            if self.max_age is not None:
+                records = [r for r in records
+                           if record.created - r.created <= self.max_age]
+            target = self.target
+            if target is not None:
+                for r in records:
+                    target.handle(r)
+                target.handle(record)
+                target.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def shouldFlush(self, record):
+        """
+        Check if the record triggers passing the buffered records on.
+        """
+        return record.levelno >= self.flushLevel
+
+    def flush(self):
+        """
+        Flush the target handler.
+
+        The buffered records are not passed on, since they are only of use
+        as the context of a record at the flush level or above.
+        """
+        target = self.target
+        if target is not None:
+            target.flush()
+
+    def close(self):
+        """
+        Close the handler, discarding the buffered records.
+        """
+        with self.buffers_lock:
+            self.buffers.clear()
+        MemoryHandler.close(self)
+
+
+def _defaultShipperAddress():
+    """
+    Return the socket of the shipper process in the runtime directory of
+    the user, which only the user can access.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        raise ValueError('XDG_RUNTIME_DIR is not set, specify the address '
+                         'of the shipper process')
+    return os.path.join(runtime_dir, SHIPPER_SOCKET_NAME)
+
+
+def _checkShipperSocket(address):
+    """
+    Raise an error unless the existing file at the address is a socket
+    of the user, since the log records are pickled on it.
+    """
+    import errno
+    import socket
+    import stat
+    st = os.lstat(address)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise socket.error(errno.EACCES,
+                           '%s is not a socket owned by this user' % address)
+
+
+class ShipperHandler(SocketHandler):
+    """
+    Handler class which sends log records to the shipper process
+    on the same host through a Unix domain socket.
+    """
+    def __init__(self, address=None):
+        """
+        Initialize the handler.
+        """
+        if address is None:
+            address = _defaultShipperAddress()
+        SocketHandler.__init__(self, address, None)
+        self.address = address
+
+    def makeSocket(self, timeout=1):
+        """
+        Make a connection to the shipper process, refusing the socket
+        that another user may have created.
+        """
+        import socket
+        if os.path.lexists(self.address):
+            _checkShipperSocket(self.address)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            s.connect(self.address)
+        except socket.error:
+            s.close()
+            raise
+        return s
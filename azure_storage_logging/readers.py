@@ -0,0 +1,333 @@
+# Copyright 2013-2015 Michiya Takahashi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import heapq
+import json
+import zlib
+from base64 import b64decode
+from collections import OrderedDict
+
+from azure_storage_logging.handlers import (COMPRESSED_MESSAGE_ENCODING,
+                                            COMPRESSED_MESSAGE_PREFIX,
+                                            IDEMPOTENCY_KEY_LENGTH,
+                                            PACKED_CHUNK_PROPERTY,
+                                            PACKED_COUNT_PROPERTY,
+                                            PLAIN_MESSAGE_PREFIX,
+                                            TEMPLATE_MESSAGE_PREFIX,
+                                            TEMPLATE_PARTITION_KEY,
+                                            TRACEBACK_PARTITION_KEY,
+                                            TRACEBACK_REFERENCE_PREFIX,
+                                            _loadCompressionDict,
+                                            _stripeSettings)
+
+
+def _decompress(data, zdict=None):
+    if zdict:
+        d = zlib.decompressobj(zlib.MAX_WBITS, zdict)
+    else:
+        d = zlib.decompressobj()
+    return (d.decompress(data) + d.flush()).decode('utf-8')
+
+
+class _SideTable(object):
+    """
+    Texts that log entities and messages refer to by their IDs, such as
+    the templates and the tracebacks, which are read from the side table
+    of the handler when they are used for the first time.
+    """
+    def __init__(self, service, table, partition_key, property_name):
+        self.service = service
+        self.table = table
+        self.partition_key = partition_key
+        self.property_name = property_name
+        self.texts = {}
+
+    def get(self, text_id):
+        """
+        Return the text of the ID.
+        """
+        text = self.texts.get(text_id)
+        if text is None:
+            entity = self.service.get_entity(self.table,
+                                             self.partition_key,
+                                             text_id)
+            text = self.texts[text_id] = entity[self.property_name]
+        return text
+
+    def render(self, template_id, args):
+        """
+        Return the log message of the template and the arguments in JSON.
+        """
+        args = json.loads(args)
+        if isinstance(args, list):
+            args = tuple(args)
+        return self.get(template_id) % args
+
+
+def _sideTables(settings, template_table, traceback_table):
+    """
+    Return the template table and the traceback table in the account
+    of the first stripe, or None for those not given.
+    """
+    if not template_table and not traceback_table:
+        return None, None
+    from azure.storage.table import TableService
+    service = TableService(account_name=settings['account_name'],
+                           account_key=settings['account_key'],
+                           is_emulated=settings['is_emulated'],
+                           protocol=settings['protocol'])
+    templates = tracebacks = None
+    if template_table:
+        templates = _SideTable(service, template_table,
+                               TEMPLATE_PARTITION_KEY, 'template')
+    if traceback_table:
+        tracebacks = _SideTable(service, traceback_table,
+                                TRACEBACK_PARTITION_KEY, 'traceback')
+    return templates, tracebacks
+
+
+class _DedupWindow(object):
+    """
+    The most recently seen keys up to the size of the window.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.keys = OrderedDict()
+
+    def seen(self, key):
+        """
+        Return True if the key is in the window, and remember it as
+        the most recent one.
+        """
+        found = self.keys.pop(key, None) is not None
+        self.keys[key] = True
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+        return found
+
+
+class QueueStorageReader(object):
+    """
+    Reader class which receives log messages sent by QueueStorageHandler
+    from a Azure Storage queue.
+    """
+    def __init__(self,
+                 account_name=None,
+                 account_key=None,
+                 protocol='https',
+                 queue='logs',
+                 base64_encoding=False,
+                 compression_dict=None,
+                 is_emulated=False,
+                 idempotent=False,
+                 dedup_window=10000,
+                 stripes=None,
+                 template_table=None,
+                 traceback_table=None,
+                 ):
+        """
+        Initialize the reader.
+        """
+        from azure.storage.queue import QueueService
+        settings = _stripeSettings(stripes, {'account_name': account_name,
+                                             'account_key': account_key,
+                                             'is_emulated': is_emulated,
+                                             'protocol': protocol,
+                                             'queue': queue})
+        self.stripes = [(QueueService(account_name=s['account_name'],
+                                      account_key=s['account_key'],
+                                      is_emulated=s['is_emulated'],
+                                      protocol=s['protocol']),
+                         s['queue'])
+                        for s in settings]
+        self.service, self.queue = self.stripes[0]
+        self.base64_encoding = base64_encoding
+        self.compression_dict = _loadCompressionDict(compression_dict)
+        self.idempotent = idempotent
+        self.dedup = _DedupWindow(dedup_window) if idempotent else None
+        self.templates, self.tracebacks = _sideTables(settings[0],
+                                                      template_table,
+                                                      traceback_table)
+
+    def decode(self, content):
+        """
+        Return the log text in the content of a queue message.
+        """
+        return self._decode(content)[1]
+
+    def _decode(self, content):
+        """
+        Return the idempotency key, None if there isn't, and the log text
+        in the content of a queue message.
+        """
+        if self.base64_encoding:
+            content = b64decode(content.encode('ascii')).decode('utf-8')
+        if content.startswith(COMPRESSED_MESSAGE_PREFIX):
+            data = b64decode(content[len(COMPRESSED_MESSAGE_PREFIX):].encode('ascii'))
+            content = _decompress(data, self.compression_dict)
+        key = None
+        if self.idempotent:
+            key = content[:IDEMPOTENCY_KEY_LENGTH]
+            content = content[IDEMPOTENCY_KEY_LENGTH+1:]
+        if content.startswith(PLAIN_MESSAGE_PREFIX):
+            content = content[len(PLAIN_MESSAGE_PREFIX):]
+        elif self.templates and content.startswith(TEMPLATE_MESSAGE_PREFIX):
+            template_id, head, tail, text = content[len(TEMPLATE_MESSAGE_PREFIX):].split(':', 3)
+            head, tail = int(head), int(tail)
+            content = '%s%s%s' % (text[:head],
+                                  self.templates.render(template_id, text[head+tail:]),
+                                  text[head:head+tail])
+        elif self.tracebacks and content.startswith(TRACEBACK_REFERENCE_PREFIX):
+            traceback_id, length, text = content[len(TRACEBACK_REFERENCE_PREFIX):].split(':', 2)
+            length = int(length)
+            content = '%s\n%s%s' % (text[:length],
+                                     self.tracebacks.get(traceback_id),
+                                     text[length+1:])
+        return key, content
+
+    def read(self, num_messages=32, visibility_timeout=None, delete=True):
+        """
+        Yield the log text of the messages in the queue until it gets empty.
+        The messages of the stripes are received from each in turn.
+
+        The messages are deleted from the queue after they are yielded
+        unless delete is False. The duplicates of the messages recently
+        yielded are skipped if the reader is idempotent.
+        """
+        while True:
+            received = False
+            for service, queue in self.stripes:
+                messages = service.get_messages(queue,
+                                                num_messages=num_messages,
+                                                visibility_timeout=visibility_timeout)
+                if not messages:
+                    continue
+                received = True
+                for message in messages:
+                    key, text = self._decode(message.content)
+                    if key is None or not self.dedup.seen(key):
+                        yield text
+                    if delete:
+                        service.delete_message(queue,
+                                               message.id,
+                                               message.pop_receipt)
+            if not received or not delete:
+                break
+
+
+class TableStorageReader(object):
+    """
+    Reader class which queries log entities written by TableStorageHandler
+    from a Azure Storage table.
+    """
+    def __init__(self,
+                 account_name=None,
+                 account_key=None,
+                 protocol='https',
+                 table='logs',
+                 compression_dict=None,
+                 is_emulated=False,
+                 stripes=None,
+                 template_table=None,
+                 traceback_table=None,
+                 ):
+        """
+        Initialize the reader.
+        """
+        from azure.storage.table import TableService
+        settings = _stripeSettings(stripes, {'account_name': account_name,
+                                             'account_key': account_key,
+                                             'is_emulated': is_emulated,
+                                             'protocol': protocol,
+                                             'table': table})
+        self.stripes = [(TableService(account_name=s['account_name'],
+                                      account_key=s['account_key'],
+                                      is_emulated=s['is_emulated'],
+                                      protocol=s['protocol']),
+                         s['table'])
+                        for s in settings]
+        self.service, self.table = self.stripes[0]
+        self.compression_dict = _loadCompressionDict(compression_dict)
+        self.templates, self.tracebacks = _sideTables(settings[0],
+                                                      template_table,
+                                                      traceback_table)
+
+    def decode(self, entity):
+        """
+        Restore the message property of an entity in place and return it.
+        """
+        if entity.get('message_encoding') == COMPRESSED_MESSAGE_ENCODING:
+            message = entity['message']
+            data = getattr(message, 'value', message)
+            entity['message'] = _decompress(data, self.compression_dict)
+            del entity['message_encoding']
+        elif self.templates and 'template_id' in entity:
+            entity['message'] = '%s%s%s' % (entity.pop('template_head', ''),
+                                            self.templates.render(entity['template_id'],
+                                                                  entity['args']),
+                                            entity.pop('template_tail', ''))
+            del entity['template_id']
+            del entity['args']
+        if self.tracebacks and 'traceback_id' in entity:
+            entity['message'] = '%s\n%s%s' % (entity['message'],
+                                              self.tracebacks.get(entity['traceback_id']),
+                                              entity['exception'])
+            del entity['traceback_id']
+            del entity['exception']
+        return entity
+
+    def read(self, filter=None):
+        """
+        Yield the entities in the table that match the OData filter.
+        The entities of the stripes are merged in the order of their
+        partition keys and row keys, and the entities that pack log
+        records are unpacked into the entities of the records.
+        """
+        if len(self.stripes) == 1:
+            entities = self.service.query_entities(self.table, filter=filter)
+        else:
+            entities = (entity for _, _, entity in heapq.merge(
+                *[self._keyed(service.query_entities(table, filter=filter), i)
+                  for i, (service, table) in enumerate(self.stripes)]))
+        for entity in entities:
+            if PACKED_COUNT_PROPERTY in entity:
+                for record in self.unpack(entity):
+                    yield self.decode(record)
+            else:
+                yield self.decode(entity)
+
+    def unpack(self, entity):
+        """
+        Return the entities of the log records packed in an entity.
+        """
+        from azure.storage.table.models import Entity
+        chunks = []
+        i = 0
+        while PACKED_CHUNK_PROPERTY % i in entity:
+            chunk = entity[PACKED_CHUNK_PROPERTY % i]
+            chunks.append(getattr(chunk, 'value', chunk))
+            i += 1
+        records = json.loads(zlib.decompress(b''.join(chunks)).decode('utf-8'))
+        entities = []
+        for record in records:
+            unpacked = Entity()
+            unpacked.update(record)
+            unpacked['PartitionKey'] = entity['PartitionKey']
+            entities.append(unpacked)
+        return entities
+
+    def _keyed(self, entities, index):
+        # the index of the stripe keeps the entities of the same keys
+        # from being compared
+        for entity in entities:
+            yield (entity['PartitionKey'], entity['RowKey']), index, entity
@@ -0,0 +1,93 @@
+# Copyright 2013-2015 Michiya Takahashi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Serializers of log records into the text of queue messages.
+"""
+import json
+import logging
+from socket import gethostname
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode('utf-8')
+    return json.dumps(obj, default=str, separators=(',', ':'))
+
+
+class JsonSerializer(object):
+    """
+    Serializer of log records into JSON objects, which uses orjson if
+    it's installed, or the standard json module otherwise.
+    """
+    # attributes of the log record and the names of their fields
+    FIELDS = (
+        ('process', 'process'),
+        ('created', 'time'),
+        ('levelname', 'level'),
+        ('name', 'logger'),
+        ('module', 'module'),
+        ('funcName', 'funcName'),
+        ('lineno', 'lineno'),
+        ('threadName', 'threadName'),
+    )
+
+    def __init__(self, extra_fields=None):
+        self.fields = self.FIELDS + tuple((f, f) for f in extra_fields or ())
+        self.formatter = logging.Formatter()
+        self.static = None
+
+    def _static(self):
+        # the hostname is encoded only once, while the process is taken
+        # from the record, which may come from another process through
+        # the shipper
+        if self.static is None:
+            self.static = _dumps({'hostname': gethostname()})[:-1] + ','
+        return self.static
+
+    def __call__(self, record):
+        fields = dict((name, getattr(record, attr, None))
+                      for attr, name in self.fields)
+        fields['message'] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+        if record.exc_text:
+            fields['exc_text'] = record.exc_text
+        stack_info = getattr(record, 'stack_info', None)
+        if stack_info:
+            fields['stack_info'] = stack_info
+        return self._static() + _dumps(fields)[1:]
+
+
+_SERIALIZERS = {
+    'json': JsonSerializer,
+}
+
+
+def get_serializer(serializer):
+    """
+    Return the serializer given as a name of the built-in one,
+    or a callable that takes a log record and returns the text.
+    """
+    if serializer is None or callable(serializer):
+        return serializer
+    try:
+        return _SERIALIZERS[serializer]()
+    except KeyError:
+        raise ValueError('unknown serializer: %r' % (serializer,))
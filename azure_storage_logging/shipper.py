@@ -0,0 +1,149 @@
+# Copyright 2013-2015 Michiya Takahashi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shipper process which receives log records from ShipperHandler
+in the worker processes on the same host and sends them to Azure Storage
+with the handlers configured in it.
+
+Run it with a logging configuration in JSON for logging.config.dictConfig:
+
+    python -m azure_storage_logging.shipper logging.json
+"""
+import errno
+import json
+import logging
+import os
+import pickle
+import signal
+import socket
+import struct
+import sys
+from logging.config import dictConfig
+
+from azure_storage_logging.handlers import (_checkShipperSocket,
+                                            _defaultShipperAddress)
+
+if sys.version_info[0] == 3:
+    import socketserver
+else:
+    import SocketServer as socketserver
+
+
+class _RecordStreamHandler(socketserver.StreamRequestHandler):
+    """
+    Receives the log records sent by ShipperHandler through a connection.
+    """
+    def handle(self):
+        while True:
+            chunk = self.rfile.read(4)
+            if len(chunk) < 4:
+                break
+            length = struct.unpack('>L', chunk)[0]
+            chunk = self.rfile.read(length)
+            if len(chunk) < length:
+                break
+            record = logging.makeLogRecord(pickle.loads(chunk))
+            self.server.ship(record)
+
+
+def _isListening(address):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(address)
+    except socket.error:
+        return False
+    finally:
+        s.close()
+    return True
+
+
+class LogShipper(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server which receives log records from the worker processes and
+    passes them to the handlers.
+
+    The records are passed to the given handlers, or to the loggers
+    of their names if no handler is given. The socket is accessible
+    only by the user running the shipper.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=None, handlers=None):
+        if address is None:
+            address = _defaultShipperAddress()
+        # remove the socket left by the previous shipper, unless another
+        # shipper is still listening on it or another user owns it
+        if os.path.lexists(address):
+            _checkShipperSocket(address)
+            if _isListening(address):
+                raise socket.error(errno.EADDRINUSE,
+                                   'another shipper is listening on %s' % address)
+            os.remove(address)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, address, _RecordStreamHandler)
+        finally:
+            os.umask(umask)
+        self.handlers = handlers
+
+    def ship(self, record):
+        """
+        Pass a log record to the handlers.
+        """
+        if self.handlers is None:
+            logging.getLogger(record.name).handle(record)
+        else:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    import argparse
+    import threading
+    parser = argparse.ArgumentParser(
+        description='Ship log records from the worker processes on this host '
+                    'to Azure Storage.')
+    parser.add_argument('config',
+                        help='logging configuration file in JSON')
+    parser.add_argument('--address',
+                        help='Unix domain socket to receive log records on '
+                             '(default: $XDG_RUNTIME_DIR/azure-storage-logging.sock)')
+    args = parser.parse_args(argv)
+    with open(args.config) as f:
+        dictConfig(json.load(f))
+    shipper = LogShipper(args.address)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return
+        threading.Thread(target=shipper.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        shipper.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shipper.server_close()
+        logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
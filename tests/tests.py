@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import os
+import struct
+import subprocess
 import sys
+import threading
 import time
 import unittest
 import zipfile
@@ -14,10 +18,37 @@ from socket import gethostname
 from threading import current_thread
 from tempfile import mkdtemp
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 from azure.storage.blob import BlockBlobService
 from azure.storage.queue import QueueService
 from azure.storage.table import TableService
 
+from azure_storage_logging.handlers import (COMPRESSED_MESSAGE_ENCODING,
+                                            COMPRESSED_MESSAGE_PREFIX,
+                                            IDEMPOTENCY_KEY_LENGTH,
+                                            BlobStorageRotatingFileHandler,
+                                            BlobStorageTimedRotatingFileHandler,
+                                            BufferBudget,
+                                            ShipperHandler,
+                                            TableStorageHandler,
+                                            _FormatWorker,
+                                            _HashRing,
+                                            _NameTemplate,
+                                            _ResourceCache,
+                                            _queueName,
+                                            _tableName,
+                                            _SpillFile,
+                                            _entitySize,
+                                            set_buffer_budget,
+                                            shutdown)
+from azure_storage_logging.readers import QueueStorageReader, TableStorageReader
+from azure_storage_logging.serializers import JsonSerializer
+from azure_storage_logging.shipper import LogShipper
+
 
 # put your Azure Storage account name and key here
 # leave them blank if you want to run the tests on Azure Storage emulator
@@ -29,6 +60,12 @@ _PY3 = sys.version_info[0] == 3
 
 _LOGFILE_TMPDIR = mkdtemp()
 
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# upper limit of the time to import the handlers module, relative to
+# the time to import the standard logging.handlers module
+_IMPORT_TIME_RATIO = 2.0
+
 _EMULATED = not ACCOUNT_NAME and not ACCOUNT_KEY
 if _EMULATED:
     ACCOUNT_NAME = None
@@ -55,6 +92,10 @@ LOGGING = {
             'format': 'mycustomrowkey-%(hostname)s-%(asctime)s',
             'datefmt': '%Y%m%d%H%M',
         },
+        'stripes_test_partition_key': {
+            # spread the entities over the stripes
+            'format': 'stripes-%(message)s',
+        },
     },
     'handlers': {
         # BlobStorageFileRotatingHandlerTest
@@ -81,6 +122,18 @@ LOGGING = {
             'container': 'logs-%s' % gethostname().replace('_', '-'),
             'max_connections': 4,
         },
+        'rotation_with_upload_workers': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.BlobStorageRotatingFileHandler',
+            'filename': os.path.join(_LOGFILE_TMPDIR, 'rotation_with_upload_workers.log'),
+            'maxBytes': 1024 * 1024,
+            'delay': True,
+            'container': 'logs-%s' % gethostname().replace('_', '-'),
+            'upload_workers': 2,
+        },
         'rotation_with_zip_compression': {
             'account_name': ACCOUNT_NAME,
             'account_key': ACCOUNT_KEY,
@@ -93,6 +146,33 @@ LOGGING = {
             'container': 'logs-%s' % gethostname().replace('_', '-'),
             'zip_compression': True,
         },
+        'rotation_with_blob_name': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.BlobStorageRotatingFileHandler',
+            'filename': os.path.join(_LOGFILE_TMPDIR, 'blob_name.log'),
+            'maxBytes': 1024 * 1024,
+            'delay': True,
+            'container': 'logs-%s' % gethostname().replace('_', '-'),
+            'blob_name': 'blob_name/%(year)s/%(month)s/%(day)s/%(hostname)s/%(filename)s',
+            'manifest': 'blob_name/%(year)s/%(month)s/%(day)s/manifest.jsonl',
+        },
+        'rotation_with_parquet': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.BlobStorageRotatingFileHandler',
+            'filename': os.path.join(_LOGFILE_TMPDIR, 'parquet.log'),
+            'maxBytes': 1024 * 1024,
+            'delay': True,
+            'container': 'logs-%s' % gethostname().replace('_', '-'),
+            'output_format': 'parquet',
+            'columns': ('funcName',),
+            'row_group_size': 1000,
+        },
         # BlobStorageTimedFileRotatingHandlerTest
         'timed_rotation': {
             'account_name': ACCOUNT_NAME,
@@ -121,6 +201,20 @@ LOGGING = {
             'container': 'logs-%s' % gethostname().replace('_', '-'),
             'zip_compression': True,
         },
+        # BlobStorageSizedTimedRotatingFileHandlerTest
+        'sized_timed_rotation': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.BlobStorageSizedTimedRotatingFileHandler',
+            'filename': os.path.join(_LOGFILE_TMPDIR, 'sized_timed_rotation.log'),
+            'maxBytes': 1024 * 1024,
+            'when': 'S',
+            'interval': 10,
+            'delay': True,
+            'container': 'logs-%s' % gethostname().replace('_', '-'),
+        },
         # QueueStorageHandlerTest
         'queue': {
             'account_name': ACCOUNT_NAME,
@@ -161,6 +255,64 @@ LOGGING = {
             'formatter': 'simple',
             'base64_encoding': True,
         },
+        'queue_compression': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'formatter': 'simple',
+            'compression_threshold': 256,
+        },
+        'queue_reserved_prefixes': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'compression_threshold': 256,
+        },
+        'queue_idempotent': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'formatter': 'simple',
+            'idempotent': True,
+        },
+        'queue_json': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'serializer': 'json',
+        },
+        'queue_template': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'formatter': 'verbose',
+            'template_table': 'QueueStorageHandlerTestTemplate',
+        },
+        'queue_defer_formatting': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'queue': 'queue-storage-handler-test',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.QueueStorageHandler',
+            'formatter': 'simple',
+            'defer_formatting': True,
+        },
         # TableStorageHandlerTest
         'table': {
             'account_name': ACCOUNT_NAME,
@@ -182,6 +334,125 @@ LOGGING = {
             'batch_size': 10,
             'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
         },
+        'batch_with_dead_letter': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'batch_size': 10,
+            'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
+            'dead_letter_table': 'TableStorageHandlerTestDeadLetter',
+        },
+        'batch_with_immediate': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'batch_size': 10,
+            'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
+            'immediate_level': 'ERROR',
+        },
+        'batch_with_packing': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'batch_size': 10,
+            'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
+            'pack_size': 5,
+        },
+        'batch_with_linger': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'batch_size': 10,
+            'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
+            'linger': 1,
+        },
+        'ring_buffer_target': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'batch_size': 10,
+            'partition_key_formatter': 'cfg://formatters.batch_test_partition_key',
+        },
+        'ring_buffer': {
+            'level': 'DEBUG',
+            'class': 'azure_storage_logging.handlers.RingBufferHandler',
+            'capacity': 5,
+            'flushLevel': 'ERROR',
+            'target': 'ring_buffer_target',
+            'key_attribute': 'request_id',
+        },
+        'dynamic_table': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest{levelname}',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+        },
+        'stripes': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'partition_key_formatter': 'cfg://formatters.stripes_test_partition_key',
+            'stripes': [
+                {'table': 'TableStorageHandlerTestStripe0'},
+                {'table': 'TableStorageHandlerTestStripe1'},
+            ],
+        },
+        'table_template': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'template_table': 'TableStorageHandlerTestTemplate',
+        },
+        'table_traceback': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'traceback_table': 'TableStorageHandlerTestTraceback',
+        },
+        'table_defer_formatting': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'defer_formatting': True,
+        },
         'extra_properties': {
             'account_name': ACCOUNT_NAME,
             'account_key': ACCOUNT_KEY,
@@ -211,6 +482,16 @@ LOGGING = {
             'partition_key_formatter': 'cfg://formatters.custom_partition_key',
             'row_key_formatter': 'cfg://formatters.custom_row_key',
         },
+        'table_compression': {
+            'account_name': ACCOUNT_NAME,
+            'account_key': ACCOUNT_KEY,
+            'is_emulated': _EMULATED,
+            'table': 'TableStorageHandlerTest',
+            'level': 'INFO',
+            'class': 'azure_storage_logging.handlers.TableStorageHandler',
+            'formatter': 'simple',
+            'compression_threshold': 256,
+        },
     },
     'loggers': {
         # BlobStorageRotatingFileHandlerTest
@@ -222,10 +503,22 @@ LOGGING = {
             'handlers': ['rotation_with_parallel_upload'],
             'level': 'DEBUG',
         },
+        'rotation_with_upload_workers': {
+            'handlers': ['rotation_with_upload_workers'],
+            'level': 'DEBUG',
+        },
         'rotation_with_zip_compression': {
             'handlers': ['rotation_with_zip_compression'],
             'level': 'DEBUG',
         },
+        'rotation_with_blob_name': {
+            'handlers': ['rotation_with_blob_name'],
+            'level': 'DEBUG',
+        },
+        'rotation_with_parquet': {
+            'handlers': ['rotation_with_parquet'],
+            'level': 'DEBUG',
+        },
         # BlobStorageTimedRotatingFileHandlerTest
         'timed_rotation': {
             'handlers': ['timed_rotation'],
@@ -235,6 +528,11 @@ LOGGING = {
             'handlers': ['timed_rotation_with_zip_compression'],
             'level': 'DEBUG',
         },
+        # BlobStorageSizedTimedRotatingFileHandlerTest
+        'sized_timed_rotation': {
+            'handlers': ['sized_timed_rotation'],
+            'level': 'DEBUG',
+        },
         # QueueStorageHandlerTest
         'queue': {
             'handlers': ['queue'],
@@ -252,6 +550,30 @@ LOGGING = {
             'handlers': ['base64_encoding'],
             'level': 'DEBUG',
         },
+        'queue_compression': {
+            'handlers': ['queue_compression'],
+            'level': 'DEBUG',
+        },
+        'queue_reserved_prefixes': {
+            'handlers': ['queue_reserved_prefixes'],
+            'level': 'DEBUG',
+        },
+        'queue_idempotent': {
+            'handlers': ['queue_idempotent'],
+            'level': 'DEBUG',
+        },
+        'queue_json': {
+            'handlers': ['queue_json'],
+            'level': 'DEBUG',
+        },
+        'queue_template': {
+            'handlers': ['queue_template'],
+            'level': 'DEBUG',
+        },
+        'queue_defer_formatting': {
+            'handlers': ['queue_defer_formatting'],
+            'level': 'DEBUG',
+        },
         # TableStorageHandlerTest
         'table': {
             'handlers': ['table'],
@@ -261,6 +583,46 @@ LOGGING = {
             'handlers': ['batch'],
             'level': 'DEBUG',
         },
+        'batch_with_dead_letter': {
+            'handlers': ['batch_with_dead_letter'],
+            'level': 'DEBUG',
+        },
+        'batch_with_immediate': {
+            'handlers': ['batch_with_immediate'],
+            'level': 'DEBUG',
+        },
+        'batch_with_packing': {
+            'handlers': ['batch_with_packing'],
+            'level': 'DEBUG',
+        },
+        'batch_with_linger': {
+            'handlers': ['batch_with_linger'],
+            'level': 'DEBUG',
+        },
+        'ring_buffer': {
+            'handlers': ['ring_buffer'],
+            'level': 'DEBUG',
+        },
+        'dynamic_table': {
+            'handlers': ['dynamic_table'],
+            'level': 'DEBUG',
+        },
+        'stripes': {
+            'handlers': ['stripes'],
+            'level': 'DEBUG',
+        },
+        'table_template': {
+            'handlers': ['table_template'],
+            'level': 'DEBUG',
+        },
+        'table_traceback': {
+            'handlers': ['table_traceback'],
+            'level': 'DEBUG',
+        },
+        'table_defer_formatting': {
+            'handlers': ['table_defer_formatting'],
+            'level': 'DEBUG',
+        },
         'extra_properties': {
             'handlers': ['extra_properties'],
             'level': 'DEBUG',
@@ -269,6 +631,10 @@ LOGGING = {
             'handlers': ['custom_keys'],
             'level': 'DEBUG',
         },
+        'table_compression': {
+            'handlers': ['table_compression'],
+            'level': 'DEBUG',
+        },
     }
 }
 
@@ -295,6 +661,76 @@ def _get_logging_config_value(kind, name, key):
     return value
 
 
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = bytearray(data[pos:pos+1])[0]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return n, pos
+
+def _read_zigzag(data, pos):
+    n, pos = _read_varint(data, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+def _read_compact_value(data, pos, ctype):
+    # read a value of the thrift compact protocol
+    if ctype in (1, 2):
+        return ctype == 1, pos
+    if ctype == 3:
+        return bytearray(data[pos:pos+1])[0], pos + 1
+    if ctype in (4, 5, 6):
+        return _read_zigzag(data, pos)
+    if ctype == 7:
+        return data[pos:pos+8], pos + 8
+    if ctype == 8:
+        length, pos = _read_varint(data, pos)
+        return data[pos:pos+length], pos + length
+    if ctype in (9, 10):
+        header = bytearray(data[pos:pos+1])[0]
+        pos += 1
+        size, etype = header >> 4, header & 0x0f
+        if size == 15:
+            size, pos = _read_varint(data, pos)
+        values = []
+        for _ in range(size):
+            value, pos = _read_compact_value(data, pos, etype)
+            values.append(value)
+        return values, pos
+    if ctype == 11:
+        size, pos = _read_varint(data, pos)
+        if not size:
+            return {}, pos
+        types = bytearray(data[pos:pos+1])[0]
+        pos += 1
+        values = {}
+        for _ in range(size):
+            key, pos = _read_compact_value(data, pos, types >> 4)
+            values[key], pos = _read_compact_value(data, pos, types & 0x0f)
+        return values, pos
+    if ctype == 12:
+        fields = {}
+        fid = 0
+        while True:
+            header = bytearray(data[pos:pos+1])[0]
+            pos += 1
+            if header == 0:
+                return fields, pos
+            if header >> 4:
+                fid += header >> 4
+            else:
+                fid, pos = _read_zigzag(data, pos)
+            fields[fid], pos = _read_compact_value(data, pos, header & 0x0f)
+    raise ValueError('unknown type: %d' % ctype)
+
+def _read_parquet_footer(data):
+    # return the fields of the FileMetaData of a parquet file by their ids
+    length = struct.unpack('<i', data[-8:-4])[0]
+    return _read_compact_value(data[-8-length:-8], 0, 12)[0]
+
+
 class _TestCase(unittest.TestCase):
 
     if not _PY3:
@@ -367,6 +803,47 @@ class BlobStorageRotatingFileHandlerTest(_BlobStorageTestCase):
     def test_rotation_with_parallel_upload(self):
         self._test_rotation('rotation_with_parallel_upload')
 
+    def test_rotation_with_upload_workers(self):
+        # get the logger for the test
+        logger_name = 'rotation_with_upload_workers'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        handler = logger.handlers[0]
+
+        # leave an outdated log file of a previous run in the directory
+        filename = _get_handler_config_value(handler_name, 'filename')
+        basename = os.path.basename(filename)
+        outdated = filename + '.2000-01-01_00-00-00'
+        with open(outdated, 'w') as f:
+            f.write('outdated\n')
+
+        # perform logging
+        log_text = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit.'
+        length_per_line = len(log_text) + len(os.linesep)
+        max_bytes = _get_handler_config_value(handler_name, 'maxBytes')
+        for _ in range(max_bytes // length_per_line + 1):
+            logger.info(log_text)
+
+        # wait for the upload workers to ship both of the outdated log files
+        deadline = time.time() + 60
+        with handler.upload_cond:
+            while handler._outdatedFiles() and time.time() < deadline:
+                handler.upload_cond.wait(1)
+            self.assertEqual(handler._outdatedFiles(), set())
+        self.assertFalse(os.path.exists(outdated))
+
+        # confirm that the outdated log files are saved in the container
+        container = self._get_container_name(handler_name)
+        blobs = list(self.service.list_blobs(container, prefix=basename))
+        self.assertEqual(len(blobs), 2)
+        self.assertEqual(blobs[0].name, os.path.basename(outdated))
+        self.assertEqual(blobs[0].properties.content_length, len('outdated\n'))
+        # the rotated log file holds every line but the last one
+        lines = max_bytes // length_per_line
+        self.assertEqual(blobs[1].properties.content_length,
+                         lines * length_per_line)
+        self.assertEqual(os.path.getsize(filename), length_per_line)
+
     def test_rotation_with_zip_compression(self):
         # get the logger for the test
         logger_name = 'rotation_with_zip_compression'
@@ -418,12 +895,107 @@ class BlobStorageRotatingFileHandlerTest(_BlobStorageTestCase):
         with self.assertRaises(StopIteration):
             next(blobs)
 
+    def test_rotation_with_blob_name(self):
+        # get the logger for the test
+        logger_name = 'rotation_with_blob_name'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
 
-class BlobStorageTimedRotatingFileHandlerTest(_BlobStorageTestCase):
+        # ensure that there's no blob under the virtual directory
+        container = self._get_container_name(handler_name)
+        if self.service.exists(container):
+            for blob in self.service.list_blobs(container, prefix='blob_name/'):
+                self.service.delete_blob(container, blob.name)
 
-    def _get_interval_in_second(self, handler_name):
-        options = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400 }
-        seconds = options[_get_handler_config_value(handler_name, 'when')]
+        # perform logging
+        log_text = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit.'
+        length_per_line = len(log_text) + len(os.linesep)
+        max_bytes = _get_handler_config_value(handler_name, 'maxBytes')
+        lines = max_bytes // length_per_line + 1
+        for _ in range(lines):
+            logger.info(log_text)
+
+        # confirm that the outdated log file is saved in the virtual directory
+        today = datetime.utcnow().strftime('%Y/%m/%d')
+        prefix = 'blob_name/%s/' % today
+        filename = _get_handler_config_value(handler_name, 'filename')
+        basename = os.path.basename(filename)
+        blobs = list(self.service.list_blobs(container, prefix=prefix))
+        self.assertEqual(len(blobs), 2)
+        blob_names = [blob.name for blob in blobs]
+        self.assertIn(prefix + 'manifest.jsonl', blob_names)
+        blob_names.remove(prefix + 'manifest.jsonl')
+        self.assertTrue(blob_names[0].startswith(prefix + gethostname() + '/' + basename))
+
+        # confirm that the manifest lists the outdated log file
+        manifest = self.service.get_blob_to_text(container, prefix + 'manifest.jsonl')
+        entries = [json.loads(line) for line in manifest.content.splitlines()]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['blob'], blob_names[0])
+        self.assertEqual(entries[0]['records'], lines - 1)
+        self.assertEqual(entries[0]['hostname'], gethostname())
+        self.assertEqual(entries[0]['process'], os.getpid())
+
+    def test_rotation_with_parquet(self):
+        # get the logger for the test
+        logger_name = 'rotation_with_parquet'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging, which writes more than a line of log_text per record
+        log_text = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit.'
+        filename = _get_handler_config_value(handler_name, 'filename')
+        container = self._get_container_name(handler_name)
+        basename = os.path.basename(filename)
+        max_bytes = _get_handler_config_value(handler_name, 'maxBytes')
+        for _ in range(max_bytes // len(log_text)):
+            logger.info(log_text)
+
+        # confirm that the outdated log files are saved in parquet format
+        blobs = list(self.service.list_blobs(container, prefix=basename))
+        self.assertGreaterEqual(len(blobs), 1)
+        blob = blobs[0]
+        self.assertTrue(blob.name.endswith('.parquet'))
+        self.assertEqual(blob.properties.content_settings.content_type,
+                         'application/vnd.apache.parquet')
+        parquet_path = os.path.join(_LOGFILE_TMPDIR, blob.name)
+        self.service.get_blob_to_path(container, blob.name, parquet_path)
+        with open(parquet_path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data[:4], b'PAR1')
+        self.assertEqual(data[-4:], b'PAR1')
+
+        # confirm that the footer has the schema and the number of rows
+        footer = _read_parquet_footer(data)
+        self.assertEqual([element[4] for element in footer[2][1:]],
+                         [b'time', b'level', b'logger', b'hostname', b'process',
+                          b'message', b'funcName'])
+        self.assertGreater(footer[3], 0)
+        self.assertEqual(footer[3], sum(row_group[3] for row_group in footer[4]))
+
+        # confirm that the columns have the log records
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return
+        table = pyarrow.parquet.read_table(parquet_path)
+        self.assertEqual(table.column_names,
+                         ['time', 'level', 'logger', 'hostname', 'process',
+                          'message', 'funcName'])
+        row = table.slice(0, 1).to_pylist()[0]
+        self.assertEqual(row['level'], 'INFO')
+        self.assertEqual(row['logger'], logger_name)
+        self.assertEqual(row['hostname'], gethostname())
+        self.assertEqual(row['process'], os.getpid())
+        self.assertEqual(row['message'], log_text)
+        self.assertEqual(row['funcName'], 'test_rotation_with_parquet')
+
+
+class BlobStorageTimedRotatingFileHandlerTest(_BlobStorageTestCase):
+
+    def _get_interval_in_second(self, handler_name):
+        options = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400 }
+        seconds = options[_get_handler_config_value(handler_name, 'when')]
         return int(_get_handler_config_value(handler_name, 'interval')) * seconds
 
     def test_timed_rotation(self):
@@ -509,6 +1081,109 @@ class BlobStorageTimedRotatingFileHandlerTest(_BlobStorageTestCase):
             self.assertRegex(f.readline(), log_text_2)
 
 
+class BlobStorageSizedTimedRotatingFileHandlerTest(_BlobStorageTestCase):
+
+    def test_sized_timed_rotation(self):
+        # get the logger for the test
+        logger_name = 'sized_timed_rotation'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging over the size limit
+        log_text = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit.'
+        length_per_line = len(log_text) + len(os.linesep)
+        max_bytes = _get_handler_config_value(handler_name, 'maxBytes')
+        for _ in range(max_bytes // length_per_line + 1):
+            logger.info(log_text)
+
+        # confirm that the log file is rotated by size
+        container = self._get_container_name(handler_name)
+        filename = _get_handler_config_value(handler_name, 'filename')
+        basename = os.path.basename(filename)
+        blobs = list(self.service.list_blobs(container, prefix=basename))
+        self.assertEqual(len(blobs), 1)
+        self.assertAlmostEqual(blobs[0].properties.content_length,
+                               max_bytes,
+                               delta=1000)
+
+        # perform logging again after the interval
+        time.sleep(int(_get_handler_config_value(handler_name, 'interval')) + 5)
+        log_text_2 = 'this will be the first line in the new log file.'
+        logger.info(log_text_2)
+
+        # confirm that the log file is rotated by time
+        blobs = list(self.service.list_blobs(container, prefix=basename))
+        self.assertEqual(len(blobs), 2)
+        for blob in blobs:
+            rotated_at = blob.name.rpartition('.')[2]
+            datetime.strptime(rotated_at, '%Y-%m-%d_%H-%M-%S')
+
+        # confirm that the current log file has correct logs
+        with open(filename, 'r') as f:
+            self.assertRegex(f.readline(), log_text_2)
+
+
+class BlobStorageFileHandlerTest(_TestCase):
+
+    def _make_handler(self, handler_class, **kwargs):
+        filename = os.path.join(mkdtemp(dir=_LOGFILE_TMPDIR), 'counting.log')
+        handler = handler_class(filename, is_emulated=True, delay=True, **kwargs)
+        self.addCleanup(handler.close)
+        # count the rollovers without rotating the file
+        handler.rollovers = []
+        handler.doRollover = lambda: handler.rollovers.append(handler._bytes)
+        return handler
+
+    def test_byte_counting(self):
+        # confirm that the handler tracks the size of the file in bytes
+        handler = self._make_handler(BlobStorageRotatingFileHandler,
+                                     maxBytes=1000,
+                                     encoding='utf-8')
+        for text in ('byte counting test', u'\u30d0\u30a4\u30c8', u'\xe9' * 100):
+            handler.handle(logging.makeLogRecord({'msg': text}))
+            self.assertEqual(handler._bytes, os.path.getsize(handler.baseFilename))
+        self.assertEqual(handler.rollovers, [])
+
+        # confirm that the handler rolls over when the file would reach
+        # maxBytes
+        left = 1000 - handler._bytes - len(os.linesep)
+        record = logging.makeLogRecord({'msg': 'x' * (left - 1)})
+        self.assertFalse(handler.shouldRollover(record))
+        record = logging.makeLogRecord({'msg': 'x' * left})
+        self.assertTrue(handler.shouldRollover(record))
+        handler.handle(record)
+        self.assertEqual(len(handler.rollovers), 1)
+
+    def test_rollover_at_record_time(self):
+        # confirm that the handler rolls over by the time of the record
+        handler = self._make_handler(BlobStorageTimedRotatingFileHandler,
+                                     when='S', interval=1)
+        handler.rolloverAt = time.time() + 100
+        record = logging.makeLogRecord({'msg': 'time test',
+                                        'created': handler.rolloverAt - 1})
+        self.assertFalse(handler.shouldRollover(record))
+        handler.handle(record)
+        record = logging.makeLogRecord({'msg': 'time test',
+                                        'created': handler.rolloverAt})
+        self.assertTrue(handler.shouldRollover(record))
+        handler.handle(record)
+        self.assertEqual(len(handler.rollovers), 1)
+
+    def test_literal_filename(self):
+        # confirm that only the %-style formats are expanded in the filename
+        # and the container
+        dirname = mkdtemp(dir=_LOGFILE_TMPDIR)
+        filename = os.path.join(dirname, '${app}-{x}-%(process)d.log')
+        handler = BlobStorageRotatingFileHandler(filename,
+                                                 is_emulated=True,
+                                                 delay=True,
+                                                 container='logs-$-%(process)d')
+        self.addCleanup(handler.close)
+        self.assertEqual(handler.baseFilename,
+                         os.path.join(dirname, '${app}-{x}-%d.log' % os.getpid()))
+        self.assertEqual(handler.container, 'logs-$-%d' % os.getpid())
+
+
 class QueueStorageHandlerTest(_TestCase):
 
     def setUp(self):
@@ -630,6 +1305,186 @@ class QueueStorageHandlerTest(_TestCase):
         with self.assertRaises(StopIteration):
             next(messages)
 
+    def test_compression(self):
+        # get the logger for the test
+        logger_name = 'queue_compression'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging with short and long text, and long text that
+        # would be larger in base64 after compression
+        short_text = 'compression test'
+        long_text = 'compression test ' * 100
+        random_text = b64encode(os.urandom(300)).decode('ascii')
+        logger.info(short_text)
+        logger.info(long_text)
+        logger.info(random_text)
+
+        # confirm that only the long text is compressed
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = iter(self.service.get_messages(queue, num_messages=3))
+        message = next(messages)
+        self.assertEqual(message.content, 'INFO %s' % short_text)
+        message = next(messages)
+        self.assertTrue(message.content.startswith(COMPRESSED_MESSAGE_PREFIX))
+        self.assertLess(len(message.content), len(long_text))
+
+        # confirm that the reader restores the long text
+        reader = QueueStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    queue=queue)
+        self.assertEqual(reader.decode(message.content), 'INFO %s' % long_text)
+        message = next(messages)
+        self.assertEqual(message.content, 'INFO %s' % random_text)
+
+        # confirm that there's no more message in the queue
+        with self.assertRaises(StopIteration):
+            next(messages)
+
+    def test_reserved_prefixes(self):
+        # get the logger for the test
+        logger_name = 'queue_reserved_prefixes'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging of short text that starts with the prefixes
+        texts = ['zlib:reserved prefixes test', 'text:reserved prefixes test']
+        for text in texts:
+            logger.info(text)
+
+        # confirm that the text is escaped and the reader restores it
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = self.service.get_messages(queue, num_messages=2)
+        self.assertEqual([message.content for message in messages],
+                         ['text:' + text for text in texts])
+        reader = QueueStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    queue=queue)
+        self.assertEqual([reader.decode(message.content) for message in messages],
+                         texts)
+
+    def test_idempotent(self):
+        # get the logger for the test
+        logger_name = 'queue_idempotent'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging twice
+        log_text = 'idempotent test'
+        logger.info('%s#1' % log_text)
+        logger.info('%s#2' % log_text)
+
+        # confirm that the messages have different keys
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = list(self.service.peek_messages(queue, num_messages=2))
+        self.assertEqual(len(messages), 2)
+        keys = set()
+        for message in messages:
+            key, text = message.content.split(' ', 1)
+            self.assertEqual(len(key), IDEMPOTENCY_KEY_LENGTH)
+            self.assertTrue(text.startswith('INFO %s' % log_text))
+            keys.add(key)
+        self.assertEqual(len(keys), 2)
+
+        # put a duplicate of the first message as a retry would do
+        self.service.put_message(queue, messages[0].content)
+
+        # confirm that the reader drops the duplicate
+        reader = QueueStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    queue=queue,
+                                    idempotent=True)
+        self.assertEqual(list(reader.read()),
+                         ['INFO %s#1' % log_text, 'INFO %s#2' % log_text])
+
+    def test_json_serializer(self):
+        # get the logger for the test
+        logger_name = 'queue_json'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging
+        log_text = 'json serializer test'
+        logger.info(log_text)
+
+        # confirm that the message is a JSON object of the log record
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = iter(self.service.get_messages(queue))
+        message = next(messages)
+        fields = json.loads(message.content)
+        self.assertEqual(fields['hostname'], gethostname())
+        self.assertEqual(fields['process'], os.getpid())
+        self.assertEqual(fields['level'], 'INFO')
+        self.assertEqual(fields['logger'], logger_name)
+        self.assertEqual(fields['funcName'], 'test_json_serializer')
+        self.assertEqual(fields['message'], log_text)
+        self.assertLessEqual(fields['time'], time.time())
+
+        # confirm that there's no more message in the queue
+        with self.assertRaises(StopIteration):
+            next(messages)
+
+    def test_template(self):
+        # get the logger for the test
+        logger_name = 'queue_template'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging with a template
+        logger.info('template test %s #%d', 'arg:1', 1)
+
+        # confirm that the message has the template ID and the arguments
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = self.service.get_messages(queue)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].content.startswith('template:'))
+        self.assertTrue(messages[0].content.endswith('["arg:1",1]'))
+
+        # confirm that the reader restores the log text with the fields
+        # of the formatter
+        template_table = _get_handler_config_value(handler_name, 'template_table')
+        reader = QueueStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    queue=queue,
+                                    template_table=template_table)
+        self.assertRegex(reader.decode(messages[0].content),
+                         r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} INFO %s %d '
+                         r'template test arg:1 #1$' % (gethostname(), os.getpid()))
+
+    def test_defer_formatting(self):
+        # get the logger for the test
+        logger_name = 'queue_defer_formatting'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        handler = logger.handlers[0]
+        errors = []
+        handler.handleError = errors.append
+        self.addCleanup(delattr, handler, 'handleError')
+
+        # perform logging with mutable and immutable arguments, and with
+        # the arguments that fail to be formatted either in this thread
+        # or in the background worker
+        items = ['before']
+        logger.info('defer formatting test %s', items)
+        items[0] = 'after'
+        logger.info('defer formatting test %s %s', items)
+        logger.info('defer formatting test %s %s', 'arg')
+        logger.info('defer formatting test %s #%d', 'arg', 1)
+
+        # confirm that the failures are handled by the handler, and the
+        # other messages are formatted as of logging
+        handler.flush()
+        self.assertEqual(len(errors), 2)
+        queue = _get_handler_config_value(handler_name, 'queue')
+        messages = self.service.get_messages(queue, num_messages=32)
+        self.assertEqual([message.content for message in messages],
+                         ["INFO defer formatting test ['before']",
+                          'INFO defer formatting test arg #1'])
+
 
 class TableStorageHandlerTest(_TestCase):
 
@@ -737,7 +1592,7 @@ class TableStorageHandlerTest(_TestCase):
         table = _get_handler_config_value(handler_name, 'table')
         entities = list(iter(self.service.query_entities(table)))
         self.assertEqual(len(entities), batch_size)
-        rowno_found = set()
+        row_key_found = set()
         seq_found = set()
         for entity in entities:
             # partition key
@@ -745,8 +1600,8 @@ class TableStorageHandlerTest(_TestCase):
             # row key
             rowno = entity.RowKey.split('-')[-1]
             self.assertLess(int(rowno), batch_size)
-            self.assertNotIn(rowno, rowno_found)
-            rowno_found.add(rowno)
+            self.assertNotIn(entity.RowKey, row_key_found)
+            row_key_found.add(entity.RowKey)
             # message
             message, seq = entity.message.split('#')
             self.assertEqual(message, 'INFO %s' % log_text)
@@ -767,15 +1622,14 @@ class TableStorageHandlerTest(_TestCase):
         # confirm that the remaining entities are committed in the next batch
         entities = list(iter(self.service.query_entities(table)))
         self.assertEqual(len(entities), batch_size)
-        rowno_found.clear()
         for entity in entities:
             # partition key
             self.assertEqual(entity.PartitionKey, 'batch-%s' % gethostname())
-            # row key
+            # row key, which is unique across the batches
             rowno = entity.RowKey.split('-')[-1]
-            self.assertLess(int(rowno), batch_size)
-            self.assertNotIn(rowno, rowno_found)
-            rowno_found.add(rowno)
+            self.assertLess(int(rowno), batch_size*2)
+            self.assertNotIn(entity.RowKey, row_key_found)
+            row_key_found.add(entity.RowKey)
             # message
             message, seq = entity.message.split('#')
             self.assertEqual(message, 'INFO %s' % log_text)
@@ -784,6 +1638,399 @@ class TableStorageHandlerTest(_TestCase):
             self.assertNotIn(seq, seq_found)
             seq_found.add(seq)
 
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_concurrency(self):
+        # get the logger for the test
+        logger_name = 'batch'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        handler = logger.handlers[0]
+        handler.flush()
+
+        # perform logging from many threads at once
+        threads, records = 8, 25
+        log_text = 'concurrency test'
+        def log(n):
+            for i in range(records):
+                logger.info('%s#%d-%d' % (log_text, n, i))
+        workers = [threading.Thread(target=log, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        handler.flush()
+
+        # confirm that every log record is committed exactly once
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), threads * records)
+        messages = set(entity.message for entity in entities)
+        self.assertEqual(messages, set('INFO %s#%d-%d' % (log_text, n, i)
+                                       for n in range(threads)
+                                       for i in range(records)))
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_with_budget(self):
+        # get the logger for the test
+        logger_name = 'batch'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        handler = logger.handlers[0]
+        handler.flush()
+
+        # perform logging with the budget that holds only an entity
+        log_text = 'budget test ' + 'x' * 200
+        set_buffer_budget(max_bytes=400, policy='block', timeout=5)
+        try:
+            started_at = time.time()
+            for i in range(3):
+                logger.info('%s#%d' % (log_text, i))
+            elapsed = time.time() - started_at
+        finally:
+            set_buffer_budget()
+
+        # confirm that the handler committed its own pending entity
+        # rather than waiting for the timeout
+        self.assertLess(elapsed, 5)
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 2)
+        handler.flush()
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 3)
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_shutdown(self):
+        # get the logger for the test
+        logger_name = 'batch'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging less than the batch size
+        batch_size = _get_handler_config_value(handler_name, 'batch_size')
+        log_text = 'shutdown test'
+        for i in range(batch_size // 2):
+            logger.info('%s#%02d' % (log_text, i))
+        table = _get_handler_config_value(handler_name, 'table')
+        self.assertEqual(len(list(self.service.query_entities(table))), 0)
+
+        # confirm that shutdown commits the ongoing batch, without
+        # draining the handlers of the other tests
+        handler = logger.handlers[0]
+        self.assertEqual(shutdown(timeout=10, handlers=[handler]), [])
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), batch_size // 2)
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_with_dead_letter(self):
+        # get the logger for the test
+        logger_name = 'batch_with_dead_letter'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        dead_letter_table = _get_handler_config_value(handler_name, 'dead_letter_table')
+        if dead_letter_table in [t.name for t in self.service.list_tables()]:
+            for entity in self.service.query_entities(dead_letter_table):
+                self.service.delete_entity(dead_letter_table,
+                                           entity.PartitionKey,
+                                           entity.RowKey)
+
+        # perform logging with a message too large for a property
+        batch_size = _get_handler_config_value(handler_name, 'batch_size')
+        log_text = 'batch logging test'
+        for i in range(batch_size):
+            if i == batch_size // 2:
+                logger.info('x' * 64 * 1024)
+            else:
+                logger.info('%s#%02d' % (log_text, i))
+
+        # confirm that the other entities are committed
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), batch_size - 1)
+        for entity in entities:
+            message, seq = entity.message.split('#')
+            self.assertEqual(message, 'INFO %s' % log_text)
+
+        # confirm that the large one is put in the dead-letter table
+        entities = list(iter(self.service.query_entities(dead_letter_table)))
+        self.assertEqual(len(entities), 1)
+        self.assertEqual(entities[0].table, table)
+        self.assertTrue(entities[0].error)
+        self.assertTrue(entities[0].message.startswith('INFO xxx'))
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_with_immediate(self):
+        # get the logger for the test
+        logger_name = 'batch_with_immediate'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging less than the batch size with an error among them
+        batch_size = _get_handler_config_value(handler_name, 'batch_size')
+        log_text = 'immediate logging test'
+        for i in range(batch_size // 2):
+            logger.info('%s#%02d' % (log_text, i))
+        logger.error('%s#%02d' % (log_text, batch_size // 2))
+
+        # confirm that only the error is transferred at once
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 1)
+        self.assertEqual(entities[0].message, 'ERROR %s#%02d' % (log_text, batch_size // 2))
+
+        # confirm that the row keys of both lanes are in the logging order
+        logging.getLogger(logger_name).handlers[0].flush()
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), batch_size // 2 + 1)
+        messages = [entity.message.split('#')[1]
+                    for entity in sorted(entities, key=lambda e: e.RowKey)]
+        self.assertEqual(messages, sorted(messages))
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_with_packing(self):
+        # get the logger for the test
+        logger_name = 'batch_with_packing'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging to fill a batch of packed entities
+        batch_size = _get_handler_config_value(handler_name, 'batch_size')
+        pack_size = _get_handler_config_value(handler_name, 'pack_size')
+        log_text = 'packing logging test'
+        for i in range(batch_size * pack_size):
+            logger.info('%s#%02d' % (log_text, i))
+
+        # confirm that the records are packed in the entities
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), batch_size)
+        for entity in entities:
+            self.assertEqual(int(entity.packed_count), pack_size)
+
+        # confirm that the reader unpacks the records
+        reader = TableStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    table=table)
+        records = list(reader.read())
+        self.assertEqual(len(set(record.RowKey for record in records)), len(records))
+        # the row keys have the row number of four digits for packing, and
+        # keep the order of logging even after rowno passes 99
+        for record in records:
+            self.assertRegex(record.RowKey, r'-\d{4}$')
+        messages = [record.message for record in records]
+        self.assertEqual(messages, ['INFO %s#%02d' % (log_text, i)
+                                    for i in range(batch_size * pack_size)])
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_batch_with_linger(self):
+        # get the logger for the test
+        logger_name = 'batch_with_linger'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging less than the batch size
+        batch_size = _get_handler_config_value(handler_name, 'batch_size')
+        log_text = 'linger logging test'
+        for i in range(batch_size // 2):
+            logger.info('%s#%02d' % (log_text, i))
+
+        # confirm that the batch is committed after the linger time
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 0)
+        linger = _get_handler_config_value(handler_name, 'linger')
+        time.sleep(linger + 2)
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), batch_size // 2)
+
+    @unittest.skipIf(_EMULATED, "Azure Storage Emulator doesn't support batch operation.")
+    def test_ring_buffer(self):
+        # get the logger for the test
+        logger_name = 'ring_buffer'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging of two requests more than the capacity
+        capacity = _get_handler_config_value(handler_name, 'capacity')
+        log_text = 'ring buffer logging test'
+        for i in range(capacity * 2):
+            logger.debug('%s#%02d' % (log_text, i), extra={'request_id': 'a'})
+            logger.debug('%s#%02d' % (log_text, i), extra={'request_id': 'b'})
+
+        # confirm that nothing is transferred yet
+        table = _get_handler_config_value('ring_buffer_target', 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 0)
+
+        # confirm that an error of a request transfers its last records
+        logger.error('%s#%02d' % (log_text, capacity * 2), extra={'request_id': 'a'})
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), capacity + 1)
+        messages = sorted(entity.message for entity in entities)
+        expected = ['DEBUG %s#%02d' % (log_text, i)
+                    for i in range(capacity, capacity * 2)]
+        expected.append('ERROR %s#%02d' % (log_text, capacity * 2))
+        self.assertEqual(messages, expected)
+
+    def test_dynamic_table(self):
+        # get the logger for the test
+        logger_name = 'dynamic_table'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        table = _get_handler_config_value(handler_name, 'table')
+        tables = [table.format(levelname=level).lower() for level in ('INFO', 'ERROR')]
+        for name in tables:
+            if name in [t.name for t in self.service.list_tables()]:
+                for entity in self.service.query_entities(name):
+                    self.service.delete_entity(name,
+                                               entity.PartitionKey,
+                                               entity.RowKey)
+
+        # perform logging in different levels
+        log_text = 'dynamic table test'
+        logger.info(log_text)
+        logger.error(log_text)
+
+        # confirm that the entities are routed to the table for the level
+        for level, name in zip(('INFO', 'ERROR'), tables):
+            entities = list(iter(self.service.query_entities(name)))
+            self.assertEqual(len(entities), 1)
+            self.assertEqual(entities[0].message, '%s %s' % (level, log_text))
+
+    def test_stripes(self):
+        # get the logger for the test
+        logger_name = 'stripes'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        stripes = _get_handler_config_value(handler_name, 'stripes')
+        for name in [stripe['table'] for stripe in stripes]:
+            if name in [t.name for t in self.service.list_tables()]:
+                for entity in self.service.query_entities(name):
+                    self.service.delete_entity(name,
+                                               entity.PartitionKey,
+                                               entity.RowKey)
+
+        # perform logging
+        log_text = 'stripes test'
+        for i in range(20):
+            logger.info('%s %02d' % (log_text, i))
+
+        # confirm that the entities are spread over the stripes
+        counts = [len(list(self.service.query_entities(stripe['table'])))
+                  for stripe in stripes]
+        self.assertEqual(sum(counts), 20)
+        for count in counts:
+            self.assertGreater(count, 0)
+
+        # confirm that the reader merges the stripes in order
+        reader = TableStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    stripes=stripes)
+        messages = [entity.message for entity in reader.read()]
+        self.assertEqual(messages, ['INFO %s %02d' % (log_text, i)
+                                    for i in range(20)])
+
+    def test_table_template(self):
+        # get the logger for the test
+        logger_name = 'table_template'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging with the same template
+        for i in range(3):
+            logger.info('template test %s #%d', 'arg', i)
+
+        # confirm that the entities have the template ID and the arguments
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 3)
+        self.assertEqual(len(set(entity.template_id for entity in entities)), 1)
+        for entity in entities:
+            self.assertFalse(hasattr(entity, 'message'))
+            self.assertEqual(entity.template_head, 'INFO ')
+
+        # confirm that the template is put in the template table only once
+        template_table = _get_handler_config_value(handler_name, 'template_table')
+        templates = list(iter(self.service.query_entities(template_table)))
+        self.assertEqual([t.template for t in templates], ['template test %s #%d'])
+
+        # confirm that the reader restores the messages
+        reader = TableStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    table=table,
+                                    template_table=template_table)
+        messages = sorted(entity.message for entity in reader.read())
+        self.assertEqual(messages, ['INFO template test arg #%d' % i for i in range(3)])
+
+    def test_table_traceback(self):
+        # get the logger for the test
+        logger_name = 'table_traceback'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging of the same traceback with different exceptions
+        log_text = 'traceback test'
+        formatter = logging.Formatter(LOGGING['formatters']['simple']['format'])
+        expected = []
+        for i in range(3):
+            try:
+                raise ValueError('%s#%d' % (log_text, i))
+            except ValueError:
+                logger.exception(log_text)
+                record = logging.makeLogRecord({'msg': log_text,
+                                                'levelname': 'ERROR',
+                                                'exc_info': sys.exc_info()})
+                expected.append(formatter.format(record))
+
+        # confirm that the entities refer to the same traceback
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 3)
+        self.assertEqual(len(set(entity.traceback_id for entity in entities)), 1)
+        for entity in entities:
+            self.assertEqual(entity.message, 'ERROR %s' % log_text)
+            self.assertTrue(entity.exception.startswith('ValueError: %s#' % log_text))
+
+        # confirm that the traceback is put in the traceback table
+        traceback_table = _get_handler_config_value(handler_name, 'traceback_table')
+        traceback = self.service.get_entity(traceback_table, 'traceback',
+                                            entities[0].traceback_id)
+        self.assertTrue(traceback.traceback.startswith('Traceback'))
+
+        # confirm that the reader restores the messages with the traceback
+        reader = TableStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    table=table,
+                                    traceback_table=traceback_table)
+        messages = sorted(entity.message for entity in reader.read())
+        self.assertEqual(messages, sorted(expected))
+
+    def test_table_defer_formatting(self):
+        # get the logger for the test
+        logger_name = 'table_defer_formatting'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+        handler = logger.handlers[0]
+
+        # perform logging with mutable and immutable arguments
+        items = ['before']
+        logger.info('defer formatting test %s', items)
+        items[0] = 'after'
+        logger.info('defer formatting test %s #%d', 'arg', 1)
+
+        # confirm that the messages are formatted as of logging
+        handler.flush()
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = list(iter(self.service.query_entities(table)))
+        self.assertEqual(len(entities), 2)
+        messages = sorted(entity.message for entity in entities)
+        self.assertEqual(messages, ["INFO defer formatting test ['before']",
+                                    'INFO defer formatting test arg #1'])
+
     def test_extra_properties(self):
         # get the logger for the test
         logger_name = 'extra_properties'
@@ -868,6 +2115,522 @@ class TableStorageHandlerTest(_TestCase):
         with self.assertRaises(StopIteration):
             next(entities)
 
+    def test_compression(self):
+        # get the logger for the test
+        logger_name = 'table_compression'
+        logger = logging.getLogger(logger_name)
+        handler_name = _get_handler_name(logger_name)
+
+        # perform logging
+        log_text = 'compression test ' * 100
+        logger.info(log_text)
+
+        # confirm that the entity has the compressed message
+        table = _get_handler_config_value(handler_name, 'table')
+        entities = iter(self.service.query_entities(table))
+        entity = next(entities)
+        self.assertEqual(entity.message_encoding, COMPRESSED_MESSAGE_ENCODING)
+
+        # confirm that the reader restores the message
+        reader = TableStorageReader(account_name=ACCOUNT_NAME,
+                                    account_key=ACCOUNT_KEY,
+                                    is_emulated=_EMULATED,
+                                    table=table)
+        entity = reader.decode(entity)
+        self.assertEqual(entity.message, 'INFO %s' % log_text)
+
+        # confirm that there's no more entity in the table
+        with self.assertRaises(StopIteration):
+            next(entities)
+
+
+class _StatusError(Exception):
+
+    def __init__(self, status_code):
+        super(_StatusError, self).__init__('status %d' % status_code)
+        self.status_code = status_code
+
+
+class ResourceCacheTest(_TestCase):
+
+    def setUp(self):
+        self.cache_dir = mkdtemp(dir=_LOGFILE_TMPDIR)
+        self.created = []
+
+    def _create(self):
+        self.created.append(True)
+
+    def test_create_once(self):
+        # confirm that the resource is created only before the first call
+        cache = _ResourceCache()
+        key = ('table', 'account', 'logs')
+        for i in range(3):
+            self.assertEqual(cache.call(key, self._create, lambda: i), i)
+        self.assertEqual(len(self.created), 1)
+
+    def test_marker(self):
+        # confirm that another cache finds the marker of the resource
+        key = ('table', 'account', 'logs')
+        _ResourceCache().call(key, self._create, lambda: None, self.cache_dir, 60)
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'table.account.logs')))
+        _ResourceCache().call(key, self._create, lambda: None, self.cache_dir, 60)
+        self.assertEqual(len(self.created), 1)
+
+    def test_marker_ttl(self):
+        # confirm that the resource is created again after the marker expires
+        key = ('queue', 'account', 'logs')
+        _ResourceCache().call(key, self._create, lambda: None, self.cache_dir, 60)
+        marker = os.path.join(self.cache_dir, 'queue.account.logs')
+        expired = time.time() - 120
+        os.utime(marker, (expired, expired))
+        _ResourceCache().call(key, self._create, lambda: None, self.cache_dir, 60)
+        self.assertEqual(len(self.created), 2)
+        self.assertGreater(os.path.getmtime(marker), expired)
+
+    def test_recreate_on_missing(self):
+        # confirm that the resource deleted after it's known to exist is
+        # created again and the call is retried
+        cache = _ResourceCache()
+        key = ('container', 'account', 'logs')
+        cache.call(key, self._create, lambda: None, self.cache_dir, 60)
+        calls = []
+        def func():
+            calls.append(True)
+            if len(calls) == 1:
+                raise _StatusError(404)
+            return 'done'
+        self.assertEqual(cache.call(key, self._create, func, self.cache_dir, 60), 'done')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.created), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'container.account.logs')))
+
+    def test_other_errors(self):
+        # confirm that the other errors are raised without creating
+        # the resource again
+        cache = _ResourceCache()
+        key = ('table', 'account', 'logs')
+        def func():
+            raise _StatusError(500)
+        with self.assertRaises(_StatusError):
+            cache.call(key, self._create, func)
+        self.assertEqual(len(self.created), 1)
+
+
+class _TestStripe(object):
+
+    def __init__(self, name, weight, backoff_until=0):
+        self.settings = {'account_name': 'account'}
+        self.resource = name
+        self.weight = weight
+        self.backoff_until = backoff_until
+
+    def healthy(self, now):
+        return now >= self.backoff_until
+
+
+class HashRingTest(_TestCase):
+
+    def test_spread(self):
+        # confirm that the keys are spread over the stripes by their weights
+        ring = _HashRing([_TestStripe('a', 1), _TestStripe('b', 3)])
+        counts = [0, 0]
+        for i in range(4000):
+            counts[ring.lookup('key%d' % i)] += 1
+        self.assertGreater(counts[0], 500)
+        self.assertGreater(counts[1], counts[0] * 2)
+
+    def test_backoff(self):
+        # confirm that the stripes backing off are passed over, including
+        # a light one that has only a point
+        stripes = [_TestStripe('a', 1, backoff_until=time.time() + 60),
+                   _TestStripe('b', 0.001)]
+        ring = _HashRing(stripes)
+        self.assertEqual(set(ring.lookup('key%d' % i) for i in range(100)), set([1]))
+
+        # confirm that the lookup ends when all of them are backing off
+        stripes[1].backoff_until = time.time() + 60
+        self.assertIn(ring.lookup('key'), (0, 1))
+
+
+class NameTemplateTest(_TestCase):
+
+    def test_queue_name(self):
+        # confirm that the dynamic queue names are made valid
+        name = _NameTemplate('logs-{name}', _queueName)
+        for logger_name, expected in (('myapp.db', 'logs-myapp-db'),
+                                      ('MyApp', 'logs-myapp'),
+                                      ('my__app.', 'logs-my-app')):
+            record = logging.makeLogRecord({'name': logger_name})
+            self.assertEqual(name.resolve(record), expected)
+        self.assertEqual(len(_queueName('q' * 100)), 63)
+
+    def test_table_name(self):
+        # confirm that the dynamic table names are made valid
+        name = _NameTemplate('{name}Logs', _tableName)
+        for logger_name, expected in (('myapp.db', 'myappdblogs'),
+                                      ('1st-app', 't1stapplogs')):
+            record = logging.makeLogRecord({'name': logger_name})
+            self.assertEqual(name.resolve(record), expected)
+
+    def test_static_name(self):
+        # confirm that the static names are kept as they are
+        name = _NameTemplate('Logs%(hostname)s', _tableName)
+        self.assertFalse(name.dynamic)
+        self.assertEqual(name.render({'hostname': 'host'}), 'Logshost')
+
+
+class BufferBudgetTest(_TestCase):
+
+    def test_drop(self):
+        # confirm that the output over the limit is dropped
+        budget = BufferBudget()
+        budget.configure(max_bytes=100, policy='drop')
+        self.assertTrue(budget.acquire(60))
+        self.assertFalse(budget.acquire(60))
+        self.assertEqual(budget.dropped, 1)
+        budget.release(60)
+        self.assertTrue(budget.acquire(60))
+
+    def test_priority_level(self):
+        # confirm that the output at the priority level is always accepted
+        budget = BufferBudget()
+        budget.configure(max_bytes=100, policy='drop')
+        self.assertTrue(budget.acquire(100))
+        self.assertTrue(budget.acquire(60, logging.ERROR))
+        self.assertFalse(budget.acquire(1, logging.WARNING))
+        self.assertEqual(budget.used, 160)
+
+    def test_block_timeout(self):
+        # confirm that the output waits for the timeout and is dropped
+        budget = BufferBudget()
+        budget.configure(max_bytes=100, policy='block', timeout=0.2)
+        self.assertTrue(budget.acquire(100))
+        self.assertTrue(budget.blocks(1))
+        started_at = time.time()
+        self.assertFalse(budget.acquire(1))
+        self.assertGreaterEqual(time.time() - started_at, 0.2)
+
+    def test_block_release(self):
+        # confirm that the output waits for the release by another thread
+        budget = BufferBudget()
+        budget.configure(max_bytes=100, policy='block', timeout=10)
+        self.assertTrue(budget.acquire(100))
+        timer = threading.Timer(0.1, budget.release, (100,))
+        timer.start()
+        started_at = time.time()
+        self.assertTrue(budget.acquire(100))
+        self.assertLess(time.time() - started_at, 10)
+        timer.join()
+
+    def test_spill(self):
+        # confirm that the output to be spilled isn't counted as dropped
+        spill_dir = mkdtemp(dir=_LOGFILE_TMPDIR)
+        budget = BufferBudget()
+        budget.configure(max_bytes=100, policy='spill', spill_dir=spill_dir)
+        self.assertFalse(budget.blocks(200))
+        self.assertFalse(budget.acquire(200))
+        self.assertEqual(budget.dropped, 0)
+        with self.assertRaises(ValueError):
+            budget.configure(policy='spill')
+
+    def test_spill_file(self):
+        # confirm that the spilled items are drained in order, and the ones
+        # appended while draining are left for the next time
+        spill = _SpillFile(os.path.join(mkdtemp(dir=_LOGFILE_TMPDIR), 'test.spill'))
+        self.assertEqual(list(spill.drain()), [])
+        for i in range(3):
+            spill.append((0, 'table', {'RowKey': '%d' % i}))
+        drained = []
+        for item in spill.drain():
+            drained.append(item[2]['RowKey'])
+            spill.append((0, 'table', {'RowKey': 'again'}))
+        self.assertEqual(drained, ['0', '1', '2'])
+        self.assertEqual([item[2]['RowKey'] for item in spill.drain()],
+                         ['again'] * 3)
+        self.assertFalse(spill.pending)
+
+    def test_entity_size(self):
+        # confirm that the size of the text is counted in utf-8
+        self.assertEqual(_entitySize({'message': u'\u3042' * 10}), len('message') + 30)
+        self.assertEqual(_entitySize({'message': b'abc', 'lineno': 1}),
+                         len('message') + 3 + len('lineno') + 8)
+
+
+class SpillTest(_TestCase):
+
+    def setUp(self):
+        self.spill_dir = mkdtemp(dir=_LOGFILE_TMPDIR)
+        # the handler never connects to the table, which is faked below
+        self.handler = TableStorageHandler(account_name='spilltest',
+                                           account_key=b64encode(b'spilltest').decode('ascii'),
+                                           table='SpillTest',
+                                           batch_size=2)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.committed = []
+        # the numbers of the calls to commit that fail
+        self.calls = 0
+        self.failing = set()
+        self.handler._commitEntities = self._commitEntities
+
+    def tearDown(self):
+        set_buffer_budget()
+        self.handler.close()
+
+    def _commitEntities(self, entities, table=None, stripe=0):
+        self.calls += 1
+        if self.calls in self.failing:
+            raise _StatusError(503)
+        self.committed.extend(entity['message'] for entity in entities)
+
+    def _record(self, msg, level=logging.INFO):
+        return logging.LogRecord('test', level, __file__, 0, msg, None, None)
+
+    def test_failed_group(self):
+        # confirm that the failed group and the rest of the spilled
+        # entities are spilled again, including the one taken last
+        set_buffer_budget(max_bytes=1, policy='spill', spill_dir=self.spill_dir)
+        for i in range(5):
+            self.handler.handle(self._record('%02d' % i))
+        self.assertEqual(self.committed, [])
+        # the first group is committed, and the second one fails
+        self.failing.add(2)
+        with self.assertRaises(_StatusError):
+            self.handler._commitSpilledEntities()
+        self.assertEqual(self.committed, ['00', '01'])
+        self.handler._commitSpilledEntities()
+        self.assertEqual(self.committed, ['00', '01', '02', '03', '04'])
+        self.assertFalse(self.handler.spill.pending)
+
+    def test_committed_after_batch(self):
+        # confirm that the spilled entities are committed after the next
+        # successful batch without flushing the handler
+        set_buffer_budget(max_bytes=1, policy='spill', spill_dir=self.spill_dir)
+        self.handler.handle(self._record('spilled#0'))
+        self.handler.handle(self._record('spilled#1'))
+        self.assertEqual(self.committed, [])
+        # the records at the priority level are always accepted
+        self.handler.handle(self._record('accepted#0', logging.ERROR))
+        self.handler.handle(self._record('accepted#1', logging.ERROR))
+        self.assertEqual(self.committed, ['accepted#0', 'accepted#1',
+                                          'spilled#0', 'spilled#1'])
+        self.assertFalse(self.handler.spill.pending)
+
+
+class FormatWorkerTest(_TestCase):
+
+    def tearDown(self):
+        set_buffer_budget()
+
+    def _record(self, msg):
+        return logging.LogRecord('test', logging.INFO, __file__, 0, msg, None, None)
+
+    def test_budget(self):
+        # confirm that the snapshots waiting for the worker are held
+        # within the buffer budget, and the ones over it are dropped
+        budget = set_buffer_budget(max_bytes=100, policy='drop')
+        dropped = budget.dropped
+        started = threading.Event()
+        resume = threading.Event()
+        sent = []
+
+        def emit(record):
+            started.set()
+            resume.wait(10)
+            sent.append(record.getMessage())
+
+        worker = _FormatWorker(emit)
+        self.addCleanup(worker.close)
+        worker.append(self._record('first'))
+        self.assertTrue(started.wait(10))
+        worker.append(self._record('x' * 60))
+        self.assertEqual(budget.used, 60)
+        worker.append(self._record('y' * 60))
+        self.assertEqual(budget.dropped, dropped + 1)
+
+        # confirm that the budget is given back when the worker takes them
+        resume.set()
+        self.assertTrue(worker.wait(time.time() + 10))
+        self.assertEqual(sent, ['first', 'x' * 60])
+        self.assertEqual(budget.used, 0)
+
+    def test_flush_timeout(self):
+        # confirm that flushing gives up on the worker stuck in sending
+        resume = threading.Event()
+        self.addCleanup(resume.set)
+        worker = _FormatWorker(lambda record: resume.wait(10))
+        self.addCleanup(worker.close)
+        worker.FLUSH_TIMEOUT = 0.2
+        worker.append(self._record('stuck'))
+        worker.append(self._record('queued'))
+        stderr = sys.stderr
+        sys.stderr = errors = StringIO()
+        try:
+            started_at = time.time()
+            self.assertFalse(worker.flush('handler'))
+            elapsed = time.time() - started_at
+        finally:
+            sys.stderr = stderr
+        self.assertLess(elapsed, 5)
+        self.assertIn("'handler' could not send 1 log records", errors.getvalue())
+        resume.set()
+        self.assertTrue(worker.flush('handler'))
+
+
+class JsonSerializerTest(_TestCase):
+
+    def test_process_of_record(self):
+        # confirm that the process is the one of the record, which may be
+        # received from another process
+        serializer = JsonSerializer()
+        for process in (12345, os.getpid()):
+            record = logging.makeLogRecord({'msg': 'json serializer test',
+                                            'process': process})
+            fields = json.loads(serializer(record))
+            self.assertEqual(fields['process'], process)
+            self.assertEqual(fields['hostname'], gethostname())
+            self.assertEqual(fields['message'], 'json serializer test')
+
+
+class _CollectingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.received = threading.Event()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.received.set()
+
+
+class ShipperTest(_TestCase):
+
+    def setUp(self):
+        self.address = os.path.join(mkdtemp(dir=_LOGFILE_TMPDIR), 'shipper.sock')
+
+    def _start_shipper(self, handlers):
+        shipper = LogShipper(self.address, handlers)
+        thread = threading.Thread(target=shipper.serve_forever)
+        thread.daemon = True
+        thread.start()
+        def stop():
+            shipper.shutdown()
+            shipper.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return shipper
+
+    def test_round_trip(self):
+        # confirm that the shipper passes the log records sent by
+        # ShipperHandler to its handlers
+        target = _CollectingHandler()
+        self._start_shipper([target])
+        handler = ShipperHandler(self.address)
+        logger = logging.getLogger('shipper_test')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.warning('shipper test %s', 'arg', extra={'worker': 'w1'})
+            self.assertTrue(target.received.wait(10))
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        record = target.records[0]
+        self.assertEqual(record.getMessage(), 'shipper test arg')
+        self.assertEqual(record.levelno, logging.WARNING)
+        self.assertEqual(record.name, 'shipper_test')
+        self.assertEqual(record.process, os.getpid())
+        self.assertEqual(record.worker, 'w1')
+
+    def test_address_in_use(self):
+        # confirm that another shipper doesn't remove the socket of
+        # the running one
+        self._start_shipper([])
+        with self.assertRaises(EnvironmentError):
+            LogShipper(self.address, [])
+        self.assertTrue(os.path.exists(self.address))
+
+    def test_stale_socket(self):
+        # confirm that the socket left by a previous shipper is removed
+        import socket
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(self.address)
+        s.close()
+        self._start_shipper([])
+        self.assertTrue(os.path.exists(self.address))
+
+    def test_socket_permissions(self):
+        # confirm that only the user can access the socket
+        self._start_shipper([])
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o600)
+
+    def test_not_socket(self):
+        # confirm that neither the shipper nor the handler uses the file
+        # at the address which isn't a socket of the user
+        with open(self.address, 'w') as f:
+            f.write('not a socket\n')
+        with self.assertRaises(EnvironmentError):
+            LogShipper(self.address, [])
+        self.assertTrue(os.path.isfile(self.address))
+        handler = ShipperHandler(self.address)
+        try:
+            with self.assertRaises(EnvironmentError):
+                handler.makeSocket()
+        finally:
+            handler.close()
+
+    def test_default_address(self):
+        # confirm that the socket is in the runtime directory of the user
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        def restore():
+            if runtime_dir is None:
+                os.environ.pop('XDG_RUNTIME_DIR', None)
+            else:
+                os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+        self.addCleanup(restore)
+        os.environ['XDG_RUNTIME_DIR'] = os.path.dirname(self.address)
+        handler = ShipperHandler()
+        handler.close()
+        self.assertEqual(handler.address,
+                         os.path.join(os.path.dirname(self.address),
+                                      'azure-storage-logging.sock'))
+        del os.environ['XDG_RUNTIME_DIR']
+        with self.assertRaises(ValueError):
+            ShipperHandler()
+
+
+class ImportTest(_TestCase):
+
+    def _run_python(self, code):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            p for p in (_PACKAGE_DIR, env.get('PYTHONPATH')) if p)
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        return output.decode('utf-8').strip()
+
+    def test_no_service_modules_on_import(self):
+        # confirm that importing the handlers doesn't load the service
+        # modules nor their dependencies
+        code = ('import sys; import azure_storage_logging.handlers; '
+                'print(",".join(sorted(m for m in sys.modules '
+                'if m.split(".")[0] in ("azure", "requests", "cryptography", '
+                '"dateutil"))))')
+        self.assertEqual(self._run_python(code), '')
+
+    def test_import_time(self):
+        # confirm that importing the handlers takes a short time compared
+        # to the standard logging modules, which is measured in the same
+        # process so that the load of the machine affects both
+        code = ('import time; t = time.time(); import logging.handlers; '
+                'base = time.time() - t; t = time.time(); '
+                'import azure_storage_logging.handlers; '
+                'print("%f %f" % (base, time.time() - t))')
+        timings = [[float(v) for v in self._run_python(code).split()]
+                   for _ in range(3)]
+        base = min(t[0] for t in timings)
+        elapsed = min(t[1] for t in timings)
+        self.assertLess(elapsed, base * _IMPORT_TIME_RATIO)
+
 
 if __name__ == '__main__':
     try: